@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import time
+import pandas as pd
+import storage
+
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+
+
+class AlertCache:
+    # Remembers the alerts sent for result tables, keyed by a fingerprint of
+    # the test_id, render mode and the table's content. A test that keeps
+    # failing with the same result reuses the image uploaded for the first
+    # alert instead of rendering and uploading it again, and with
+    # suppress_seconds set the repeat alert isn't posted at all within that
+    # window. Entries are JSON files in a local directory or under a
+    # gs://bucket/prefix location, and are ignored once older than ttl_seconds.
+    def __init__(self, utils, credentials, location=None, ttl_seconds=None, suppress_seconds=None):
+        self.utils = utils
+        self.credentials = credentials
+        self.location = location if location is not None else \
+            os.environ.get("ANOMA_ALERT_CACHE_LOCATION", "/tmp/anoma_bot_alert_cache")
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else \
+            int(os.environ.get("ANOMA_ALERT_CACHE_TTL_SECONDS", DEFAULT_TTL_SECONDS))
+        self.suppress_seconds = suppress_seconds if suppress_seconds is not None else \
+            int(os.environ.get("ANOMA_ALERT_SUPPRESS_SECONDS", 0))
+
+    def fingerprint(self, test_id, df, render_mode):
+        digest = hashlib.sha256()
+        digest.update(f"{test_id}|{render_mode}|".encode())
+        digest.update(json.dumps([str(column) for column in df.columns]).encode())
+        digest.update(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return self.location.rstrip('/') + f"/alert_{key}.json"
+
+    def get(self, key):
+        path = self._path(key)
+
+        try:
+            content = storage.read_bytes(path, self.utils, self.credentials)
+
+            if content is None:
+                return None
+
+            entry = json.loads(content)
+        except Exception as e:
+            print(f"Couldn't read alert cache entry {path}: {e}")
+            return None
+
+        if time.time() - entry["created_at"] > self.ttl_seconds:
+            return None
+
+        return entry
+
+    def put(self, key, entry):
+        path = self._path(key)
+
+        try:
+            storage.write_bytes(
+                path, 
+                json.dumps(entry).encode(), 
+                self.utils, 
+                self.credentials, 
+                content_type="application/json"
+            )
+        except Exception as e:
+            print(f"Couldn't write alert cache entry {path}: {e}")
+
+    def is_suppressed(self, entry):
+        return entry is not None and self.suppress_seconds > 0 and \
+            time.time() - entry["notified_at"] < self.suppress_seconds
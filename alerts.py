@@ -1,15 +1,271 @@
-from email.mime import multipart
+# smtplib/email are only needed by Email and dataframe_image (which pulls in
+# matplotlib) only when a table is rendered, so both are imported on use
+import hashlib
 import io
-import smtplib
+import os
 import traceback
-import pandas as pd
-from email.mime.application import MIMEApplication
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import random
+import threading
+import time
 import requests
 import json
-import dataframe_image as dfi
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from email.utils import parsedate_to_datetime
 from io import BytesIO
+from requests.adapters import HTTPAdapter
+import metrics
+
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Slack rejects section blocks with more than 3000 characters of text
+SLACK_SECTION_MAX_CHARS = 3000
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session():
+    # One keep-alive session per process, so repeated uploads and webhook
+    # posts reuse their TLS connections
+    global _http_session
+
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20)
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+
+        return _http_session
+
+
+def _retry_after_seconds(response):
+    retry_after = response.headers.get("Retry-After", None)
+
+    if retry_after is None:
+        return None
+
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        try:
+            return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+def post_with_retry(url, timeout=(5, 30), max_retries=4, backoff_seconds=1, max_retry_after_seconds=60, **kwargs):
+    # POSTs through the shared session, retrying connection errors, 429s and
+    # 5xx responses with exponential backoff (honouring Retry-After). A
+    # Retry-After longer than max_retry_after_seconds isn't waited out: that
+    # response is returned as is, so one rate-limited webhook can't stall the
+    # run. Returns the last response, or raises the last connection error.
+    session = get_http_session()
+
+    for attempt in range(max_retries + 1):
+        try:
+            response = session.post(url, timeout=timeout, **kwargs)
+
+            if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+                return response
+
+            wait_seconds = _retry_after_seconds(response)
+
+            if wait_seconds is not None and wait_seconds > max_retry_after_seconds:
+                print(f"POST {url.split('?')[0]} returned {response.status_code} with Retry-After "
+                      f"{wait_seconds:.0f}s, over the {max_retry_after_seconds}s cap, not retrying")
+                return response
+
+            print(f"POST {url.split('?')[0]} returned {response.status_code}, retrying")
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == max_retries:
+                raise
+
+            wait_seconds = None
+            print(f"POST {url.split('?')[0]} failed ({e}), retrying")
+
+        if wait_seconds is None:
+            wait_seconds = backoff_seconds * (2 ** attempt) + random.uniform(0, backoff_seconds)
+
+        time.sleep(wait_seconds)
+
+
+@lru_cache(maxsize=1)
+def _get_table_font():
+    from PIL import ImageFont
+
+    return ImageFont.load_default()
+
+
+_png_cache = OrderedDict()
+_png_cache_lock = threading.Lock()
+PNG_CACHE_SIZE = 64
+
+
+def _render_table_png(table_text):
+    key = hashlib.sha1(table_text.encode()).hexdigest()
+
+    with _png_cache_lock:
+        if key in _png_cache:
+            _png_cache.move_to_end(key)
+            return _png_cache[key]
+
+    from PIL import Image, ImageDraw
+
+    font = _get_table_font()
+    lines = table_text.splitlines()
+    padding = 10
+    line_height = font.getbbox("Ag|")[3] + 6
+    width = max(font.getbbox(line)[2] for line in lines) + 2 * padding
+    height = line_height * len(lines) + 2 * padding
+
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+
+    for i, line in enumerate(lines):
+        draw.text((padding, padding + i * line_height), line, fill="black", font=font)
+
+    # Rule under the header row
+    draw.line([(padding, padding + line_height - 3), (width - padding, padding + line_height - 3)], fill="gray")
+
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    png = buffer.getvalue()
+
+    with _png_cache_lock:
+        _png_cache[key] = png
+
+        while len(_png_cache) > PNG_CACHE_SIZE:
+            _png_cache.popitem(last=False)
+
+    return png
+
+
+def _is_transient_smtp_error(error):
+    import smtplib
+
+    # Dropped connections and 4xx replies are worth retrying, 5xx replies
+    # (bad credentials, refused recipients, rejected content) aren't
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+
+    # SMTPException subclasses OSError, so its other errors (e.g. every
+    # recipient refused, an unsupported command) are ruled out first
+    if isinstance(error, smtplib.SMTPException):
+        return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError))
+
+    return isinstance(error, OSError)
+
+
+class EmailSender:
+    # One authenticated SMTP session for a batch of emails, used as a
+    # context manager. Messages are sent over the same connection, and a
+    # transient failure (dropped connection, 4xx reply) is retried with
+    # exponential backoff, reconnecting when the session was lost. The
+    # server and login come from SMTP_HOST, SMTP_PORT, SMTP_USE_SSL,
+    # SMTP_USER and SMTP_PASSWORD.
+    def __init__(self, host=None, port=None, use_ssl=None, user=None, password=None, timeout=30, 
+                    max_retries=3, backoff_seconds=1):
+        self.host = host if host is not None else os.environ.get("SMTP_HOST", "smtp.gmail.com")
+        self.port = int(port if port is not None else os.environ.get("SMTP_PORT", 465))
+        self.use_ssl = use_ssl if use_ssl is not None else \
+            os.environ.get("SMTP_USE_SSL", "true").lower() == "true"
+        self.user = user if user is not None else os.environ.get("SMTP_USER", "<email>")
+        self.password = password if password is not None else os.environ.get("SMTP_PASSWORD", "<password>")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.connections = 0
+        self.sent = 0
+        self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def _connect(self):
+        import smtplib
+
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+
+        try:
+            server.ehlo()
+
+            if self.password not in (None, ""):
+                server.login(self.user, self.password)
+        except Exception:
+            server.close()
+            raise
+
+        self.connections += 1
+        self._server = server
+
+    def close(self):
+        if self._server is None:
+            return
+
+        try:
+            self._server.quit()
+        except Exception:
+            self._server.close()
+
+        self._server = None
+
+    def send(self, message, receivers):
+        # message: an email.message.Message; receivers: an address or a list of them
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self._server is None:
+                    self._connect()
+
+                self._server.send_message(message, from_addr=self.user, to_addrs=receivers)
+                self.sent += 1
+                return
+            except Exception as e:
+                if not _is_transient_smtp_error(e) or attempt == self.max_retries:
+                    raise
+
+                print(f"Sending email to {receivers} failed ({e}), retrying")
+
+                # After a 4xx reply the session is still usable once reset,
+                # anything else means reconnecting
+                try:
+                    if self._server is not None:
+                        self._server.rset()
+                except Exception:
+                    self._server.close()
+                    self._server = None
+
+            time.sleep(self.backoff_seconds * (2 ** attempt) + random.uniform(0, self.backoff_seconds))
+
+    def send_all(self, emails):
+        # emails: (Email, receivers) pairs. Each Email's attachment is built
+        # once, however many receivers it goes to. Returns the receivers
+        # that couldn't be sent to.
+        failed = []
+        sent = 0
+
+        with metrics.span('email_send'):
+            for email, receivers in emails:
+                try:
+                    self.send(email.build_message(self.user, receivers), receivers)
+                    sent += 1
+                except Exception:
+                    print(f"Failed to email {receivers}: {traceback.format_exc()}")
+                    failed.append(receivers)
+
+        metrics.add('emails_sent', sent)
+
+        return failed
 
 
 class Email:
@@ -19,70 +275,134 @@ class Email:
         self.test = test
         self.message = f"This is to notify you that an anomaly has been detected " + \
         f"in {self.project} for {self.test}\n\n"
+        self._parts = None
 
     def _export_csv(self, df):
         with io.StringIO() as buffer:
             df.to_csv(buffer, index=False)
             return buffer.getvalue()
 
-    def _get_email_content(self, receivers):
-        gmail_user = "<email>"
-        gmail_password = "<password>" # to be changed after considering
+    def _get_parts(self):
+        # The CSV attachment and the body are built and encoded once, then
+        # shared by the message of every receiver
+        from email.mime.application import MIMEApplication
+        from email.mime.text import MIMEText
 
-        body = self.message
+        if self._parts is None:
+            attachment = MIMEApplication(self._export_csv(self.anomalies_df))
+            attachment['Content-Disposition'] = 'attachment; filename="{}"'.format('anomabot_update.csv')
+            self._parts = [attachment, MIMEText(self.message, 'plain')]
 
-        multipart = MIMEMultipart()
+        return self._parts
 
-        multipart["from"] = gmail_user
-        multipart["to"] = receivers
+    def build_message(self, sender, receivers):
+        from email.mime.multipart import MIMEMultipart
 
-        attachment = MIMEApplication(self._export_csv(self.anomalies_df))
-        attachment['Content-Disposition'] = 'attachment; filename="{}"'.format('anomabot_update.csv')
-        multipart.attach(attachment)
-        multipart.attach(MIMEText(body, 'plain'))
+        multipart = MIMEMultipart()
 
-        return gmail_user, gmail_password, multipart
+        multipart["from"] = sender
+        multipart["to"] = receivers if isinstance(receivers, str) else ", ".join(receivers)
 
-    def send_email(self, receivers):
-        try:            
-            user, password, multipart = self._get_email_content(receivers)
+        for part in self._get_parts():
+            multipart.attach(part)
 
-            server = smtplib.SMTP_SSL('smtp.gmail.com', 465)
-            server.ehlo()
-            server.login(user, password)
-            server.sendmail(user, receivers, multipart.as_string())
-            server.close()
+        return multipart
+
+    def send_email(self, receivers, sender=None):
+        # Sends over the given EmailSender's session, or over a session of its own
+        try:
+            if sender is not None:
+                sender.send(self.build_message(sender.user, receivers), receivers)
+            else:
+                with EmailSender() as own_sender:
+                    own_sender.send(self.build_message(own_sender.user, receivers), receivers)
         except:
             print(f"{traceback.format_exc()}")
 
 
 class Slack:
-    def __init__(self):
-        self.webhook = "<slack webhook url>"
+    def __init__(self, dry_run=False, alert_cache=None):
+        self.webhook = os.environ.get("SLACK_WEBHOOK_URL", "<slack webhook url>")
+        # Overridable so alerts can be sent to a self-hosted GitLab or a local sink
+        self.gitlab_url = os.environ.get("GITLAB_URL", "https://gitlab.com")
+        # In dry runs tables are still rendered, but nothing is uploaded or posted
+        self.dry_run = dry_run
+        self.timeout = (5, 30)
+        self.max_retries = 4
+        self.max_table_rows = 10
+        # With render_mode 'auto', tables up to this many rows are posted as
+        # Slack blocks and larger ones as a lightweight PNG
+        self.blocks_max_rows = 10
+        # Optional alert_cache.AlertCache for repeated result tables
+        self.alert_cache = alert_cache
 
     def df_to_image_buffer(self, df):
+        import dataframe_image as dfi
+
         buffer = BytesIO()
-        dfi.export(df, buffer, table_conversion='matplotlib', max_rows=10)
+        dfi.export(df, buffer, table_conversion='matplotlib', max_rows=self.max_table_rows)
         buffer.seek(0)
         return buffer
 
+    def df_to_table_text(self, df):
+        shown_df = df.head(self.max_table_rows)
+        text = shown_df.to_string(index=False)
+
+        if df.shape[0] > shown_df.shape[0]:
+            text += f"\n... {df.shape[0] - shown_df.shape[0]} more rows"
+
+        return text
+
+    def df_to_png_buffer(self, df):
+        # Draws the plain-text table with Pillow instead of going through
+        # matplotlib. Rendered images are cached by their table text.
+        return BytesIO(_render_table_png(self.df_to_table_text(df)))
+
+    def resolve_render_mode(self, df, render_mode):
+        if render_mode == 'auto':
+            return 'blocks' if df.shape[0] <= self.blocks_max_rows else 'png'
+
+        if render_mode in ('blocks', 'png'):
+            return render_mode
+
+        return 'image'
+
     def upload_image_to_gitlab(self, project_id, filename, buffer_image, gitlab_token):
+        if self.dry_run:
+            print(f"Dry run, not uploading {filename} ({len(buffer_image.getvalue())} bytes)")
+            return {'full_path': '/dry-run/' + filename}
+
         try:
-            url = 'https://gitlab.com/api/v4/projects/{0}/uploads'.format(project_id)
+            url = '{0}/api/v4/projects/{1}/uploads'.format(self.gitlab_url, project_id)
             headers = {'PRIVATE-TOKEN': gitlab_token}
-            files = {'file': (filename, buffer_image, 'text/plain')}
-            r = requests.post(url, headers=headers, files=files)
+            # Bytes rather than the buffer, so a retry re-sends the whole image
+            files = {'file': (filename, buffer_image.getvalue(), 'text/plain')}
+            r = post_with_retry(url, timeout=self.timeout, max_retries=self.max_retries, headers=headers, files=files)
             print(r)
-            # while r.status_code not in [200 ,201]:
-            #     time.sleep(1)
+            r.raise_for_status()
             return r.json()
         except Exception as e:
             print("error in upload_image_to_gitlab()")
             print("Error: ", str(e))
 
 
-    def send_message_via_webhook(self, message, image):
-        if image is None:
+    def send_message_via_webhook(self, message, image, table_text=None):
+        if self.dry_run:
+            print(f"Dry run, not posting to Slack: {message} {image or ''}")
+            if table_text is not None:
+                print(table_text)
+            return None
+
+        if table_text is not None:
+            code_block = "```" + table_text[:SLACK_SECTION_MAX_CHARS - 6] + "```"
+            body = {
+                "text": message, 
+                "blocks": [
+                    {"type": "section", "text": {"type": "mrkdwn", "text": message[:SLACK_SECTION_MAX_CHARS]}}, 
+                    {"type": "section", "text": {"type": "mrkdwn", "text": code_block}}
+                ]
+            }
+        elif image is None:
             body = {
                 "text": message, 
             }
@@ -95,10 +415,134 @@ class Slack:
                 }]
             }
 
-        r = requests.post(
-            self.webhook, 
-            data=json.dumps(body), 
-            headers={'Content-Type': 'application/json'}
-        )
+        with metrics.span('slack_post'):
+            r = post_with_retry(
+                self.webhook, 
+                timeout=self.timeout, 
+                max_retries=self.max_retries, 
+                data=json.dumps(body), 
+                headers={'Content-Type': 'application/json'}
+            )
+
+        # Raised rather than returned, so the test (or the AlertQueue) records
+        # the alert as failed; the message leaves out the secret webhook URL
+        if r.status_code >= 400:
+            raise RuntimeError(f"Slack webhook returned {r.status_code}: {r.text}")
+
+        metrics.add('alerts_sent')
 
         return r
+
+    def send_alert(self, message, df=None, git_project_id=None, git_token=None, render_mode='image', test_id=None):
+        # Renders df (if given), uploads it to GitLab and posts the message with
+        # the image. If the upload fails the message is still posted, without it.
+        # render_mode 'blocks' posts the table as Slack blocks with no image,
+        # 'png' uses the lightweight renderer, 'auto' picks by row count and
+        # 'image' (the default) renders through dataframe_image.
+        # With an alert_cache and a test_id, a table already alerted on reuses
+        # its uploaded image, or isn't posted again within the suppress window.
+        image = None
+        render_mode = None if df is None else self.resolve_render_mode(df, render_mode)
+
+        cache_key = None
+        cache_entry = None
+
+        if df is not None and self.alert_cache is not None and test_id is not None and not self.dry_run:
+            cache_key = self.alert_cache.fingerprint(test_id, df, render_mode)
+            cache_entry = self.alert_cache.get(cache_key)
+
+            if cache_entry is not None:
+                metrics.add('alert_cache_hits')
+
+            if self.alert_cache.is_suppressed(cache_entry):
+                print(f"Result for test {test_id} unchanged since the last alert, not posting it again")
+                metrics.add('alerts_suppressed')
+                return None
+
+        if render_mode == 'blocks':
+            with metrics.span('render'):
+                table_text = self.df_to_table_text(df)
+
+            response = self.send_message_via_webhook(message, image=None, table_text=table_text)
+        else:
+            if cache_entry is not None and cache_entry["image_url"] is not None:
+                image = cache_entry["image_url"]
+                print('Reusing image Url: ' + image)
+            elif df is not None:
+                with metrics.span('render'):
+                    if render_mode == 'png':
+                        image_buffer = self.df_to_png_buffer(df)
+                    else:
+                        image_buffer = self.df_to_image_buffer(df)
+
+                with metrics.span('gitlab_upload'):
+                    jsn = self.upload_image_to_gitlab(git_project_id, 
+                        "Test.png",
+                        image_buffer,
+                        git_token
+                    )
+
+                if jsn is not None and 'full_path' in jsn:
+                    image = self.gitlab_url + jsn['full_path']
+                    print('Image Url: ' + image)
+                else:
+                    message += " (the result image couldn't be uploaded)"
+
+            response = self.send_message_via_webhook(message, image=image)
+
+        # Failed uploads and posts aren't cached, so the next run tries again
+        # instead of taking the alert as already sent (a failed post raises
+        # before getting here)
+        if cache_key is not None and response is not None and response.status_code < 400 and \
+                (render_mode == 'blocks' or image is not None):
+            now = time.time()
+            self.alert_cache.put(cache_key, {
+                "test_id": str(test_id), 
+                "render_mode": render_mode, 
+                "image_url": image, 
+                "created_at": now if cache_entry is None else cache_entry["created_at"], 
+                "notified_at": now
+            })
+
+        return response
+
+
+class AlertQueue:
+    # Delivers alerts on a small thread pool, so one test's image upload
+    # overlaps with other tests' rendering and posting, and a slow endpoint
+    # doesn't hold up the test that produced the alert. Call wait() before the
+    # process exits.
+    def __init__(self, max_workers=4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def submit(self, slack, message, df=None, git_project_id=None, git_token=None, render_mode='image', test_id=None):
+        # Bound to the caller's context so the delivery is recorded in its run metrics
+        future = self._executor.submit(metrics.bind(slack.send_alert), message, df, git_project_id, git_token, render_mode, test_id)
+
+        with self._lock:
+            self._futures.append((test_id, message, future))
+
+        return future
+
+    def wait(self):
+        # Returns (test_id, message) for every alert that couldn't be delivered
+        with self._lock:
+            futures, self._futures = self._futures, []
+
+        failed = []
+
+        for test_id, message, future in futures:
+            try:
+                future.result()
+            except Exception:
+                print(f"Failed to deliver alert '{message}': {traceback.format_exc()}")
+                failed.append((test_id, message))
+
+        return failed
+
+    def shutdown(self):
+        failed = self.wait()
+        self._executor.shutdown()
+        return failed
@@ -0,0 +1,85 @@
+import io
+import os
+import numpy as np
+import pandas as pd
+import storage
+
+
+DEFAULT_WINDOW_DAYS = 365
+
+
+class AnomalyStateStore:
+    # Keeps the trailing window of each incremental anomaly test's pivot
+    # (dates x series) between runs, so a run only needs to query the newest
+    # day(s). States are stored as .npz files in a local directory or under a
+    # gs://bucket/prefix location.
+    def __init__(self, location=None):
+        self.location = location if location is not None else \
+            os.environ.get("ANOMA_STATE_LOCATION", "/tmp/anoma_bot_state")
+
+    def _path(self, test_id):
+        return self.location.rstrip('/') + f"/anomaly_state_{test_id}.npz"
+
+    def load(self, utils, credentials, test_id):
+        path = self._path(test_id)
+
+        try:
+            content = storage.read_bytes(path, utils, credentials)
+
+            if content is None:
+                return None
+
+            with np.load(io.BytesIO(content), allow_pickle=False) as state:
+                state_pivot = pd.DataFrame(
+                    state["values"],
+                    index=pd.DatetimeIndex(state["dates"].astype("datetime64[D]"), name='date'),
+                    columns=pd.Index(state["series"], name='column_to_pivot_on')
+                )
+
+            # A state without days has no last day to resume from
+            if state_pivot.shape[0] == 0:
+                print(f"Anomaly state at {path} has no days, rebuilding")
+                return None
+
+            return state_pivot
+        except Exception as e:
+            print(f"Couldn't load anomaly state from {path}, rebuilding: {e}")
+            return None
+
+    def save(self, utils, credentials, test_id, pivot_df):
+        path = self._path(test_id)
+
+        buffer = io.BytesIO()
+        np.savez_compressed(
+            buffer,
+            values=pivot_df.to_numpy(dtype=np.float64, na_value=np.nan),
+            dates=pivot_df.index.to_numpy(dtype="datetime64[D]").astype(str),
+            series=pivot_df.columns.to_numpy(dtype=str)
+        )
+
+        storage.write_bytes(path, buffer.getvalue(), utils, credentials)
+
+        print(f"Saved anomaly state for test {test_id}: {pivot_df.shape[0]} days x {pivot_df.shape[1]} series")
+
+
+def merge_state_pivot(state_pivot, new_pivot, window_days):
+    # The newly fetched days replace any day already in the state (the last
+    # state day is always re-fetched, to pick up rows that arrived late), and
+    # only the last window_days + 1 days are kept: window_days of history plus
+    # the day being evaluated. The window counts days present in the data.
+    new_pivot = new_pivot.copy()
+    new_pivot.index = pd.DatetimeIndex(pd.to_datetime(new_pivot.index), name='date')
+    new_pivot.columns.name = 'column_to_pivot_on'
+
+    if state_pivot is None or new_pivot.shape[0] == 0:
+        merged_pivot = new_pivot if state_pivot is None else state_pivot
+    else:
+        merged_pivot = pd.concat([
+            state_pivot[state_pivot.index < new_pivot.index.min()],
+            new_pivot
+        ]).sort_index(axis=1)
+
+    merged_pivot = merged_pivot.sort_index().iloc[-(window_days + 1):]
+
+    # Series that have no value left in the window are dropped, as pivot_table would
+    return merged_pivot.dropna(axis=1, how='all')
@@ -0,0 +1,584 @@
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from fakes import make_pivot
+from utils import Utils
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_detection(series, days, threshold):
+    utils = Utils()
+    pivot_df = make_pivot(series, days)
+
+    legacy_df, legacy_seconds = timed(
+        lambda: utils.check_anomaly(pivot_df.apply(utils.get_last_anomalous, axis=0, threshold=threshold))
+    )
+    vectorized_df, vectorized_seconds = timed(utils.detect_anomalies, pivot_df, threshold)
+
+    pd.testing.assert_frame_equal(legacy_df, vectorized_df, check_exact=True)
+
+    print(f"detection: {series} series x {days} days, threshold {threshold}, {vectorized_df.shape[0]} anomalies")
+    print(f"  per-column apply: {legacy_seconds:.3f}s")
+    print(f"  vectorized:       {vectorized_seconds:.3f}s")
+    print(f"  speedup:          {legacy_seconds / vectorized_seconds:.1f}x")
+
+
+def make_query_result_table(series, days):
+    import pyarrow as pa
+
+    pivot_df = make_pivot(series, days, missing_ratio=0)
+    long_df = pivot_df.stack().rename('current_day_rows').reset_index()
+
+    return pa.Table.from_pandas(long_df, preserve_index=False)
+
+
+def fetch_with_dicts(table):
+    # What get_query_results_as_df used to do: one dict per row, then a frame
+    return pd.DataFrame([dict(row) for row in table.to_pylist()])
+
+
+def fetch_with_arrow(table):
+    # RowIterator.to_dataframe decodes the Arrow result column-wise
+    return table.to_pandas()
+
+
+def make_result_pages(series, days, page_rows=100000):
+    # Query result pages as BigQuery returns them: one object-dtype string
+    # key per row. Pages are built on demand, so the full result is never in
+    # memory unless the consumer keeps it.
+    rng = np.random.default_rng(0)
+    names = np.array([f"dataset_{i % 100}|table_{i}" for i in range(series)], dtype=object)
+    dates = pd.date_range(end=pd.Timestamp.today().normalize(), periods=days).date
+
+    for start in range(0, series * days, page_rows):
+        cells = np.arange(start, min(start + page_rows, series * days))
+        values = rng.normal(1000, 50, size=len(cells)).round()
+        spikes = (cells // series == days - 1) & (rng.random(len(cells)) < 0.01)
+        values[spikes] *= 3
+
+        yield pd.DataFrame({
+            'date': dates[cells // series], 
+            'column_to_pivot_on': names[cells % series], 
+            'current_day_rows': values
+        })
+
+
+def _measure_pivot_memory(path, series, days, threshold):
+    import tracemalloc
+
+    utils = Utils()
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    if path == 'pivot_table':
+        query_result_df = pd.concat(make_result_pages(series, days), ignore_index=True)
+        pivot_df = query_result_df.pivot_table(index='date', columns='column_to_pivot_on', values='current_day_rows')
+        del query_result_df
+        anomalies_df = utils.detect_anomalies(pivot_df, threshold)
+    else:
+        anomalies_df = utils.detect_anomalies_compact(utils.compact_result_frames(make_result_pages(series, days)), threshold)
+
+    seconds = time.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak_bytes / 1024 ** 2, anomalies_df.shape[0]
+
+
+def bench_pivot_memory(series, days, threshold):
+    rows = series * days
+    print(f"pivot + detection memory: {series} series x {days} days ({rows} rows)")
+
+    context = multiprocessing.get_context('spawn')
+
+    for path in ['pivot_table', 'compact']:
+        with context.Pool(1) as pool:
+            seconds, peak_mb, anomalies = pool.apply(_measure_pivot_memory, (path, series, days, threshold))
+
+        # Times are inflated by tracemalloc, compare them with each other only
+        print(f"  {path:<12} {seconds:8.3f}s  peak {peak_mb:8.1f} MB  ({peak_mb / rows * 1e6:6.1f} MB per million rows)  {anomalies} anomalies")
+
+
+def fetch_streaming(table, batch_rows=100000):
+    return Utils().pivot_from_frames(batch.to_pandas() for batch in table.to_batches(max_chunksize=batch_rows))
+
+
+def _measure_fetch(path, series, days):
+    table = make_query_result_table(series, days)
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+
+    if path == 'dicts':
+        pivot_df = fetch_with_dicts(table).pivot_table(index='date', columns='column_to_pivot_on', values='current_day_rows')
+    elif path == 'arrow':
+        pivot_df = fetch_with_arrow(table).pivot_table(index='date', columns='column_to_pivot_on', values='current_day_rows')
+    else:
+        pivot_df = fetch_streaming(table)
+
+    seconds = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return seconds, (peak_kb - baseline_kb) / 1024, pivot_df.shape
+
+
+def bench_fetch(series, days):
+    print(f"fetch + pivot: {series} series x {days} days ({series * days} rows)")
+
+    # Each path runs in a fresh process so peak RSS isn't shared between them
+    context = multiprocessing.get_context('spawn')
+
+    for path in ['dicts', 'arrow', 'streaming']:
+        with context.Pool(1) as pool:
+            seconds, extra_mb, shape = pool.apply(_measure_fetch, (path, series, days))
+
+        print(f"  {path:<10} {seconds:8.3f}s  peak +{extra_mb:8.1f} MB  pivot {shape}")
+
+
+def make_alert_frame(rows, seed=0):
+    rng = np.random.default_rng(seed)
+
+    return pd.DataFrame({
+        'dataset|table': [f"dataset_{i % 100}|table_{i}" for i in range(rows)], 
+        "today's rows": rng.normal(3000, 50, size=rows).round(), 
+        '10%': rng.normal(900, 50, size=rows).round(), 
+        '90%': rng.normal(1100, 50, size=rows).round()
+    })
+
+
+def bench_render(row_counts, repeats):
+    from alerts import Slack, _png_cache
+
+    slack = Slack(dry_run=True)
+
+    renderers = [
+        ('image', slack.df_to_image_buffer), 
+        ('png', slack.df_to_png_buffer), 
+        ('blocks', slack.df_to_table_text)
+    ]
+
+    print(f"alert table render, best of {repeats} (max {slack.max_table_rows} rows shown)")
+
+    for rows in row_counts:
+        df = make_alert_frame(rows)
+
+        for name, render in renderers:
+            try:
+                seconds = []
+
+                for _ in range(repeats):
+                    # Time the render itself, not the cached PNG
+                    _png_cache.clear()
+                    seconds.append(timed(render, df)[1])
+            except ImportError as e:
+                print(f"  {rows:>6} rows  {name:<7} skipped ({e})")
+                continue
+
+            print(f"  {rows:>6} rows  {name:<7} {min(seconds) * 1000:9.1f} ms")
+
+
+def bench_history(tests, series, tables, days, anomaly_ratio=0.01, seed=0):
+    from datetime import datetime, timedelta
+    from run_history import RunHistoryStore
+
+    rng = np.random.default_rng(seed)
+    store = RunHistoryStore(os.path.join(tempfile.mkdtemp(prefix="anoma_bot_bench_"), "history.sqlite"))
+    series_names = [f"dataset_{i % 10}|table_{i}" for i in range(series)]
+    last_run = datetime.now()
+
+    def record_day(day):
+        run_at = last_run - timedelta(days=day)
+
+        for test in range(tests):
+            store.record_anomaly_series(f"anomaly_{test}", pd.DataFrame({
+                'dataset|table': series_names, 
+                "today's rows": rng.integers(0, 100000, series).astype(np.float64), 
+                "10%": rng.integers(0, 50000, series).astype(np.float64), 
+                "90%": rng.integers(50000, 100000, series).astype(np.float64), 
+                'anomaly': rng.random(series) < anomaly_ratio
+            }), 10, run_at=run_at)
+            store.record_table_checks(f"no_of_rows_{test}", 'no_of_rows', [
+                (f"dataset.table_{table}", int(rng.integers(0, 100000)), None, None) for table in range(tables)
+            ], run_at=run_at)
+
+    _, record_seconds = timed(lambda: [record_day(day) for day in range(days)])
+
+    print(f"run history: {tests} anomaly tests x {series} series and {tests} no_of_rows tests x {tables} tables, {days} days")
+    print(f"  recording:       {record_seconds / (days * tests) * 1000:.1f} ms per anomaly + no_of_rows run")
+
+    for period, periods in (('weekly', 8), ('monthly', 12)):
+        (tables_df, anomalies_df), seconds = timed(store.report, period, periods)
+        print(f"  {period + ' report':<16} {seconds * 1000:.1f} ms ({tables_df.shape[0]} table rows, {anomalies_df.shape[0]} anomaly rows)")
+
+
+def bench_email(messages, rows, connect_latency, latency, transient_failures):
+    from alerts import Email, EmailSender
+    from fakes import LocalSMTPSink
+
+    df = make_alert_frame(rows)
+    receivers = [f"team_{i}@example.com" for i in range(messages)]
+
+    print(f"email: {messages} recipient groups, {rows}-row CSV attachment, "
+          f"{connect_latency * 1000:.0f} ms connect + {latency * 1000:.0f} ms per command, "
+          f"{transient_failures} transient failures")
+
+    def per_message(sink):
+        # A session, login and CSV export per recipient group
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for receiver in receivers:
+                Email("project", "test", df).send_email(receiver)
+
+    def batched(sink):
+        # One session, and one CSV export shared by every recipient group
+        email = Email("project", "test", df)
+
+        with EmailSender(backoff_seconds=0.01) as sender:
+            failed = sender.send_all([(email, receiver) for receiver in receivers])
+
+        assert len(failed) == 0, failed
+
+    for name, send in (('per-message sessions', per_message), ('one batched session', batched)):
+        with LocalSMTPSink(latency=latency, connect_latency=connect_latency, transient_failures=transient_failures) as sink:
+            os.environ.update({'SMTP_HOST': sink.host, 'SMTP_PORT': str(sink.port), 'SMTP_USE_SSL': 'false'})
+            _, seconds = timed(send, sink)
+
+            print(f"  {name:<21} {seconds:7.3f}s  {messages / seconds:8.1f} emails/s  "
+                  f"{sink.connections} connections, {sink.logins} logins, {sink.messages} delivered")
+
+
+def bench_shared_scan(tests, tables, series, days, query_latency):
+    import main
+    from config_store import TestConfigStore
+    from fakes import FakeUtils, LocalHTTPSink, SyntheticWarehouse, make_test_sheet
+    from metrics import RunMetrics
+
+    work_dir = tempfile.mkdtemp(prefix="anoma_bot_bench_")
+    os.environ.update({
+        'ANOMA_ALERT_CACHE_LOCATION': os.path.join(work_dir, 'alerts'), 
+        'ANOMA_HISTORY_PATH': ''
+    })
+
+    sheet_df = make_test_sheet(tests, 0, 0, anomaly_tables=tables)
+    # Different windows and thresholds per test, as tests on one table usually have
+    sheet_df['lookback_days'] = [str([90, 180, ''][i % 3]) for i in range(tests)]
+    sheet_df['threshold'] = [str([5, 10, 25][i % 3]) for i in range(tests)]
+
+    print(f"shared scan: {tests} anomaly tests on {tables} tables, {series} series x {days} days, "
+          f"{query_latency * 1000:.0f} ms per query")
+
+    for shared in ('false', 'true'):
+        os.environ['ANOMA_SHARED_SCANS'] = shared
+        utils = FakeUtils(SyntheticWarehouse(series=series, days=days, query_latency=query_latency), sheet_df)
+        tests_config = TestConfigStore(ttl_seconds=0).get_all_tests(utils, utils.credentials)
+
+        with LocalHTTPSink() as sink, open(os.devnull, 'w') as devnull:
+            os.environ.update({'SLACK_WEBHOOK_URL': sink.url + '/webhook', 'GITLAB_URL': sink.url})
+
+            with contextlib.redirect_stdout(devnull), RunMetrics('benchmark', emit=False) as run_metrics:
+                summary = main.run_selected_tests(tests_config, list(tests_config), utils, utils.credentials)
+
+        # Each test records into its own run metrics, so the batch's queries
+        # are counted by the warehouse instead
+        print(f"  shared scans {shared:<5}  {run_metrics.seconds:7.3f}s  {utils.warehouse.queries} queries  "
+              f"{summary['succeeded']}/{len(tests_config)} tests ok")
+
+
+def _run_offline_scenario(scenario, query_latency, http_latency):
+    # Runs one scenario end to end against the fakes, in a fresh process.
+    # The run's own logging is discarded.
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return _measure_offline_scenario(scenario, query_latency, http_latency)
+
+
+def _measure_offline_scenario(scenario, query_latency, http_latency):
+    import main
+    from config_store import TestConfigStore
+    from fakes import FakeSchedulerService, FakeUtils, LocalHTTPSink, SyntheticWarehouse, make_test_sheet
+    from metrics import RunMetrics
+
+    test_type = scenario['test_type']
+    work_dir = tempfile.mkdtemp(prefix="anoma_bot_bench_")
+    os.environ.update({
+        'ANOMA_STATE_LOCATION': os.path.join(work_dir, 'state'), 
+        'ANOMA_ALERT_CACHE_LOCATION': os.path.join(work_dir, 'alerts')
+    })
+
+    warehouse = SyntheticWarehouse(
+        series=scenario.get('series', 100), 
+        days=scenario.get('days', 365), 
+        query_latency=query_latency
+    )
+
+    if test_type == 'anomaly':
+        sheet_df = make_test_sheet(1, 0, 0, execution_mode=scenario['execution_mode'])
+        units = scenario['series'] * scenario['days']
+        # The synthetic table is generated up front, it's the warehouse's data
+        warehouse.get_long_table('anomaly_1')
+    elif test_type == 'no_of_rows':
+        sheet_df = make_test_sheet(0, 0, 1, tables_per_test=scenario['tables'])
+        units = scenario['tables']
+    else:
+        sheet_df = make_test_sheet(0, scenario['tests'], 0)
+        units = scenario['tests']
+
+    utils = FakeUtils(warehouse, sheet_df)
+    tests = TestConfigStore(ttl_seconds=0).get_all_tests(utils, utils.credentials)
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    with LocalHTTPSink(latency=http_latency) as sink:
+        os.environ.update({'SLACK_WEBHOOK_URL': sink.url + '/webhook', 'GITLAB_URL': sink.url})
+
+        # Batch runs record their spans in each test's own run metrics
+        with RunMetrics('benchmark', emit=False) as run_metrics:
+            if test_type == 'scheduler':
+                from scheduler import Scheduler
+
+                Scheduler(utils=utils, scheduler_service=FakeSchedulerService(latency=http_latency)).reconcile()
+            elif test_type == 'data_arrived_or_not':
+                main.run_selected_tests(tests, list(tests), utils, utils.credentials)
+            else:
+                main.run_test(tests['1'], utils, utils.credentials)
+
+        http_requests = sink.requests
+
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return {
+        **scenario, 
+        'seconds': run_metrics.seconds, 
+        'peak_extra_mb': (peak_kb - baseline_kb) / 1024, 
+        'throughput': units / run_metrics.seconds, 
+        'http_requests': http_requests, 
+        'spans': {name: round(total, 4) for name, (total, _) in run_metrics.spans.items()}
+    }
+
+
+def _scenario_key(scenario):
+    return "|".join(f"{name}={scenario[name]}" for name in sorted(scenario) if name in SCENARIO_FIELDS)
+
+
+SCENARIO_FIELDS = ('test_type', 'execution_mode', 'series', 'days', 'tables', 'tests')
+THROUGHPUT_UNITS = {'anomaly': 'rows/s', 'no_of_rows': 'tables/s', 'data_arrived_or_not': 'tests/s', 'scheduler': 'jobs/s'}
+
+
+def bench_offline(test_types, series_counts, day_counts, table_counts, test_counts, execution_mode, 
+                    query_latency_ms, http_latency_ms, output_path=None, baseline_path=None):
+    scenarios = []
+
+    for test_type in test_types:
+        if test_type == 'anomaly':
+            scenarios += [
+                {'test_type': test_type, 'execution_mode': execution_mode, 'series': series, 'days': days} 
+                for series, days in itertools.product(series_counts, day_counts)
+            ]
+        elif test_type == 'no_of_rows':
+            scenarios += [{'test_type': test_type, 'tables': tables} for tables in table_counts]
+        else:
+            scenarios += [{'test_type': test_type, 'tests': tests} for tests in test_counts]
+
+    baseline = {}
+
+    if baseline_path is not None:
+        with open(baseline_path, "r") as baseline_file:
+            baseline = {_scenario_key(result): result for result in json.load(baseline_file)}
+
+    print(f"offline end-to-end runs (query latency {query_latency_ms} ms, HTTP latency {http_latency_ms} ms)")
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+
+    for scenario in scenarios:
+        label = ", ".join(f"{name} {scenario[name]}" for name in SCENARIO_FIELDS[1:] if scenario.get(name) is not None)
+
+        try:
+            with context.Pool(1) as pool:
+                result = pool.apply(_run_offline_scenario, (scenario, query_latency_ms / 1000, http_latency_ms / 1000))
+        except ImportError as e:
+            print(f"  {scenario['test_type']:<20} {label:<32} skipped ({e})")
+            continue
+
+        results.append(result)
+        top_spans = sorted(result['spans'].items(), key=lambda span: span[1], reverse=True)[:3]
+
+        line = f"  {result['test_type']:<20} {label:<32} {result['seconds']:8.3f}s  peak +{result['peak_extra_mb']:7.1f} MB  " + \
+            f"{result['throughput']:12.0f} {THROUGHPUT_UNITS[result['test_type']]:<9}"
+
+        if _scenario_key(result) in baseline:
+            line += f"  {result['seconds'] / baseline[_scenario_key(result)]['seconds']:5.2f}x baseline"
+
+        print(line)
+
+        if len(top_spans) > 0:
+            print("      " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in top_spans))
+
+    if output_path is not None:
+        with open(output_path, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+        print(f"Results written to {output_path}")
+
+
+# Cold-start budget for importing the function entry point, and modules that
+# must not be loaded by that import because only some code paths need them
+IMPORT_TIME_BUDGET_MS = 1500
+LAZY_MODULES = [
+    'dataframe_image', 
+    'matplotlib', 
+    'smtplib', 
+    'email.mime', 
+    'googleapiclient', 
+    'google.cloud.bigquery', 
+    'google.cloud.bigquery_storage', 
+    'google.cloud.storage'
+]
+
+
+def bench_import_time(budget_ms, top):
+    # Same breakdown as `python -X importtime -c "import main"`, in a fresh
+    # interpreter so nothing is already imported
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import main'], 
+        cwd=os.path.dirname(os.path.abspath(__file__)), 
+        capture_output=True, 
+        text=True
+    )
+
+    if result.returncode != 0:
+        print('\n'.join(result.stderr.splitlines()[-5:]))
+        raise SystemExit("import main failed")
+
+    imports = []
+    main_imports = []
+    total_ms = 0
+
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _, self_us, cumulative_us, name = line.replace('import time:', '|').split('|')
+        level = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), level, int(cumulative_us)))
+
+        # Children are printed before their parent, so the level 1 imports
+        # listed right before `main` are the ones main pulled in directly
+        if level == 0 and name.strip() == 'main':
+            total_ms = int(cumulative_us) / 1000
+            main_imports = imports
+        elif level == 0:
+            imports = []
+
+    top_level = sorted([i for i in main_imports if i[1] == 1], key=lambda i: i[2], reverse=True)
+    loaded_lazy_modules = sorted({
+        name for name, _, _ in main_imports 
+        for module in LAZY_MODULES if name == module or name.startswith(module + '.')
+    })
+
+    print(f"import main: {total_ms:.1f} ms (budget {budget_ms} ms)")
+
+    for name, _, cumulative_us in top_level[:top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    if len(loaded_lazy_modules) > 0:
+        print(f"  loaded modules that should be lazy: {', '.join(loaded_lazy_modules)}")
+
+    if total_ms > budget_ms or len(loaded_lazy_modules) > 0:
+        raise SystemExit("import-time budget exceeded")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Anoma Bot benchmarks")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    detection_parser = subparsers.add_parser('detection', help="per-column vs vectorized anomaly detection")
+    detection_parser.add_argument('--series', type=int, default=10000)
+    detection_parser.add_argument('--days', type=int, default=365)
+    detection_parser.add_argument('--threshold', type=float, default=10)
+
+    fetch_parser = subparsers.add_parser('fetch', help="dict-per-row vs Arrow vs streaming result fetch")
+    fetch_parser.add_argument('--series', type=int, default=2000)
+    fetch_parser.add_argument('--days', type=int, default=365)
+
+    render_parser = subparsers.add_parser('render', help="dataframe_image vs lightweight PNG vs Slack blocks alert rendering")
+    render_parser.add_argument('--rows', type=int, nargs='+', default=[5, 10, 100, 1000])
+    render_parser.add_argument('--repeats', type=int, default=3)
+
+    offline_parser = subparsers.add_parser('offline', help="end-to-end test runs against local BigQuery/Sheets/Slack/GitLab stand-ins")
+    offline_parser.add_argument('--test-types', nargs='+', default=['anomaly', 'no_of_rows', 'data_arrived_or_not', 'scheduler'])
+    offline_parser.add_argument('--series', type=int, nargs='+', default=[100, 1000, 10000])
+    offline_parser.add_argument('--days', type=int, nargs='+', default=[90, 365])
+    offline_parser.add_argument('--tables', type=int, nargs='+', default=[1, 10, 50])
+    offline_parser.add_argument('--tests', type=int, nargs='+', default=[1, 10, 50])
+    offline_parser.add_argument('--execution-mode', default=None, help="execution_mode of the anomaly tests")
+    offline_parser.add_argument('--query-latency-ms', type=float, default=0)
+    offline_parser.add_argument('--http-latency-ms', type=float, default=0)
+    offline_parser.add_argument('--output', default=None, help="write results as JSON, to compare later runs against")
+    offline_parser.add_argument('--baseline', default=None, help="results JSON of an earlier run to compare with")
+
+    pivot_memory_parser = subparsers.add_parser('pivot-memory', help="pivot_table vs compact pivot peak memory")
+    pivot_memory_parser.add_argument('--series', type=int, default=20000)
+    pivot_memory_parser.add_argument('--days', type=int, default=365)
+    pivot_memory_parser.add_argument('--threshold', type=float, default=10)
+
+    email_parser = subparsers.add_parser('email', help="per-message vs batched SMTP sessions against a local SMTP stand-in")
+    email_parser.add_argument('--messages', type=int, default=200)
+    email_parser.add_argument('--rows', type=int, default=1000)
+    email_parser.add_argument('--connect-latency-ms', type=float, default=50, help="per connection, for the TLS handshake and login")
+    email_parser.add_argument('--latency-ms', type=float, default=1, help="per SMTP command")
+    email_parser.add_argument('--transient-failures', type=int, default=0, help="451 replies to the first MAIL commands")
+
+    shared_scan_parser = subparsers.add_parser('shared-scan', help="one query per anomaly test vs one shared query per table")
+    shared_scan_parser.add_argument('--tests', type=int, default=20)
+    shared_scan_parser.add_argument('--tables', type=int, default=4)
+    shared_scan_parser.add_argument('--series', type=int, default=500)
+    shared_scan_parser.add_argument('--days', type=int, default=365)
+    shared_scan_parser.add_argument('--query-latency-ms', type=float, default=500)
+
+    history_parser = subparsers.add_parser('history', help="run-history recording and weekly/monthly report latency")
+    history_parser.add_argument('--tests', type=int, default=10)
+    history_parser.add_argument('--series', type=int, default=500)
+    history_parser.add_argument('--tables', type=int, default=10)
+    history_parser.add_argument('--days', type=int, default=365)
+
+    import_time_parser = subparsers.add_parser('importtime', help="cold-start import time of the function entry point")
+    import_time_parser.add_argument('--budget-ms', type=float, default=IMPORT_TIME_BUDGET_MS)
+    import_time_parser.add_argument('--top', type=int, default=15)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'detection':
+        bench_detection(args.series, args.days, args.threshold)
+    elif args.benchmark == 'fetch':
+        bench_fetch(args.series, args.days)
+    elif args.benchmark == 'render':
+        bench_render(args.rows, args.repeats)
+    elif args.benchmark == 'pivot-memory':
+        bench_pivot_memory(args.series, args.days, args.threshold)
+    elif args.benchmark == 'offline':
+        bench_offline(
+            args.test_types, args.series, args.days, args.tables, args.tests, args.execution_mode, 
+            args.query_latency_ms, args.http_latency_ms, output_path=args.output, baseline_path=args.baseline
+        )
+    elif args.benchmark == 'email':
+        bench_email(args.messages, args.rows, args.connect_latency_ms / 1000, args.latency_ms / 1000, args.transient_failures)
+    elif args.benchmark == 'shared-scan':
+        bench_shared_scan(args.tests, args.tables, args.series, args.days, args.query_latency_ms / 1000)
+    elif args.benchmark == 'history':
+        bench_history(args.tests, args.series, args.tables, args.days)
+    elif args.benchmark == 'importtime':
+        bench_import_time(args.budget_ms, args.top)
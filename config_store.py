@@ -0,0 +1,223 @@
+from collections import namedtuple
+import json
+import os
+import threading
+import time
+import metrics
+import storage
+
+
+TEST_FIELDS = (
+    'test_id',
+    'test_name',
+    'test_type',
+    'project_name',
+    'main_table_name',
+    'date_column_name',
+    'dataset_column_name',
+    'dataset_table_column_name',
+    'entries_column_name',
+    'threshold',
+    'slack_member_id',
+    'cron_schedule',
+    'timezone',
+    'use_partition_metadata',
+    'lookback_days',
+    'max_bytes_processed',
+    'bytes_budget_action',
+    'execution_mode',
+    'render_mode'
+)
+
+FLOAT_FIELDS = ('threshold',)
+INT_FIELDS = ('lookback_days', 'max_bytes_processed')
+BOOL_FIELDS = ('use_partition_metadata',)
+
+# One row of the queries sheet / config.json. A test_id can span several rows
+# (e.g. no_of_rows tests list one table per row), so tests are stored as tuples
+# of rows keyed by test_id.
+TestRow = namedtuple('TestRow', TEST_FIELDS)
+
+
+def parse_test_row(record):
+    values = {}
+
+    for field in TEST_FIELDS:
+        value = record.get(field, None)
+
+        if isinstance(value, str):
+            value = value.strip()
+
+        # Sheet rows come back with '' (or missing trailing cells) for unset values
+        if value == '':
+            value = None
+
+        try:
+            if value is not None and field in FLOAT_FIELDS:
+                value = float(value)
+
+            if value is not None and field in INT_FIELDS:
+                value = int(float(value))
+        except (TypeError, ValueError):
+            raise ValueError(f"invalid {field} {value!r}")
+
+        # Sheet checkboxes come back as 'TRUE'/'FALSE'
+        if field in BOOL_FIELDS:
+            value = str(value).lower() in ('true', 'yes', '1')
+
+        values[field] = value
+
+    values['test_id'] = str(values['test_id'])
+
+    return TestRow(**values)
+
+
+class TestConfigStore:
+    # In-memory, test_id-indexed snapshot of the test configuration. The
+    # snapshot is reused until the TTL expires; after that the sheet revision
+    # (or config.json mtime) is checked and the rows are only re-read when it
+    # changed. Snapshots are also persisted to disk so a cold start on the same
+    # instance can skip the sheet read.
+    def __init__(self, read_from_config_json=False, ttl_seconds=None, cache_path=None):
+        self.read_from_config_json = read_from_config_json
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else \
+            int(os.environ.get("ANOMA_CONFIG_TTL_SECONDS", 300))
+        self.cache_path = cache_path if cache_path is not None else \
+            os.environ.get("ANOMA_CONFIG_CACHE_PATH", None)
+        self.config_json_path = "config.json"
+
+        self.tests = None
+        self.revision = None
+        self.loaded_at = 0
+        self._lock = threading.Lock()
+
+    def get_test(self, utils, credentials, test_id):
+        self.ensure_fresh(utils, credentials)
+
+        # A test missing from a snapshot still within its TTL may have just
+        # been added to the sheet, so the revision is checked before giving up
+        if str(test_id) not in self.tests:
+            self.ensure_fresh(utils, credentials, check_revision=True)
+
+        return self.tests.get(str(test_id), ())
+
+    def get_all_tests(self, utils, credentials, force_refresh=False):
+        self.ensure_fresh(utils, credentials, force_refresh=force_refresh)
+        return self.tests
+
+    def ensure_fresh(self, utils, credentials, force_refresh=False, check_revision=False):
+        # check_revision skips the TTL, so the revision is always compared
+        with self._lock:
+            if self.tests is None and not force_refresh:
+                self._load_snapshot()
+
+            if self.tests is not None and not force_refresh and not check_revision and \
+                    time.time() - self.loaded_at < self.ttl_seconds:
+                metrics.add('config_cache_hits')
+                return
+
+            revision = self._get_revision(utils, credentials)
+
+            if self.tests is not None and not force_refresh and \
+                    revision is not None and revision == self.revision:
+                print(f"Test config unchanged at revision {revision}")
+                metrics.add('config_cache_hits')
+                self.loaded_at = time.time()
+                self._save_snapshot()
+                return
+
+            self._load_from_source(utils, credentials, revision)
+
+    def _get_revision(self, utils, credentials):
+        try:
+            if self.read_from_config_json:
+                return str(os.path.getmtime(self.config_json_path))
+            return utils.get_sheet_revision(credentials)
+        except Exception as e:
+            print(f"Couldn't read test config revision: {e}")
+            return None
+
+    def _load_from_source(self, utils, credentials, revision):
+        if self.read_from_config_json:
+            with open(self.config_json_path, "r") as config_file:
+                records = json.load(config_file)["tests"]
+        else:
+            records = utils.get_sheet_as_df(credentials, "queries").to_dict('records')
+
+        self._index(self._parse_records(records))
+        metrics.add('config_loads')
+        self.revision = revision
+        self.loaded_at = time.time()
+
+        print(f"Loaded {len(self.tests)} tests from " + \
+            f"{'config.json' if self.read_from_config_json else 'queries sheet'} at revision {revision}")
+
+        self._save_snapshot()
+
+    def _parse_records(self, records):
+        # A row with a malformed cell is skipped (and logged) on its own, so
+        # it doesn't keep every other test from loading
+        for record in records:
+            try:
+                yield parse_test_row(record)
+            except ValueError as e:
+                print(f"Skipping config row of test {record.get('test_id', None)}: {e}")
+                metrics.add('config_row_errors')
+
+    def _index(self, rows):
+        tests = {}
+
+        for row in rows:
+            tests.setdefault(row.test_id, []).append(row)
+
+        self.tests = {test_id: tuple(test_rows) for test_id, test_rows in tests.items()}
+
+    def _load_snapshot(self):
+        if self.cache_path is None:
+            return
+
+        try:
+            content = storage.read_bytes(self.cache_path)
+
+            if content is None:
+                return
+
+            snapshot = json.loads(content)
+
+            if snapshot["fields"] != list(TEST_FIELDS) or \
+                    snapshot["read_from_config_json"] != self.read_from_config_json:
+                return
+
+            self._index(TestRow(*row) for row in snapshot["rows"])
+            self.revision = snapshot["revision"]
+            self.loaded_at = snapshot["loaded_at"]
+        except Exception as e:
+            print(f"Ignoring unreadable test config snapshot {self.cache_path}: {e}")
+
+    def _save_snapshot(self):
+        if self.cache_path is None:
+            return
+
+        snapshot = {
+            "fields": list(TEST_FIELDS),
+            "read_from_config_json": self.read_from_config_json,
+            "revision": self.revision,
+            "loaded_at": self.loaded_at,
+            "rows": [list(row) for test_rows in self.tests.values() for row in test_rows]
+        }
+
+        try:
+            storage.write_bytes(self.cache_path, json.dumps(snapshot).encode(), content_type="application/json")
+        except Exception as e:
+            print(f"Couldn't persist test config snapshot to {self.cache_path}: {e}")
+
+
+_config_stores = {}
+
+
+def get_config_store(read_from_config_json=False):
+    # Process-level stores, so warm invocations resolve tests from memory
+    if read_from_config_json not in _config_stores:
+        _config_stores[read_from_config_json] = TestConfigStore(read_from_config_json=read_from_config_json)
+
+    return _config_stores[read_from_config_json]
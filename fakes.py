@@ -0,0 +1,545 @@
+import json
+import re
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+import numpy as np
+import pandas as pd
+import metrics
+from config_store import TEST_FIELDS
+from utils import Utils
+
+
+# In-process stand-ins for BigQuery, the queries sheet, Cloud Scheduler, Slack,
+# GitLab and an SMTP server, so the code paths of main, Utils and Scheduler can be run and
+# benchmarked offline. Nothing here is used by the deployed functions.
+
+
+def make_pivot(series, days, missing_ratio=0.05, anomaly_ratio=0.01, seed=0):
+    rng = np.random.default_rng(seed)
+
+    values = rng.normal(1000, 50, size=(days, series)).round()
+    values[rng.random((days, series)) < missing_ratio] = np.nan
+
+    spikes = rng.random(series) < anomaly_ratio
+    values[-1, spikes] = values[-1, spikes] * 3
+
+    return pd.DataFrame(
+        values, 
+        index=pd.Index(pd.date_range(end=pd.Timestamp.today().normalize(), periods=days).date, name='date'), 
+        columns=pd.Index([f"dataset_{i % 100}|table_{i}" for i in range(series)], name='column_to_pivot_on')
+    )
+
+
+def make_test_sheet(anomaly_tests=1, data_arrived_tests=1, no_of_rows_tests=1, tables_per_test=1, 
+                        execution_mode=None, render_mode='png', threshold=10, lookback_days=None, anomaly_tables=None):
+    # Rows of the queries sheet, as get_sheet_as_df returns them (all strings).
+    # Every test reads its own synthetic table, except that with anomaly_tables
+    # the anomaly tests are spread over that many shared tables, and
+    # no_of_rows tests list tables_per_test tables each.
+    rows = []
+
+    def add_row(test_id, test_type, table_name, **fields):
+        row = {field: '' for field in TEST_FIELDS}
+        row.update({
+            'test_id': str(test_id), 
+            'test_name': f"{test_type} test {test_id}", 
+            'test_type': test_type, 
+            'project_name': 'fake-project', 
+            'main_table_name': f"fake-project.fake_dataset.{table_name}", 
+            'date_column_name': 'date', 
+            'slack_member_id': 'U000000', 
+            'cron_schedule': '0 9 * * *', 
+            'timezone': 'UTC', 
+            'render_mode': render_mode or ''
+        })
+        row.update({field: '' if value is None else str(value) for field, value in fields.items()})
+        rows.append(row)
+
+    test_id = 1
+
+    for i in range(anomaly_tests):
+        add_row(
+            test_id, 'anomaly', f"anomaly_{test_id if anomaly_tables is None else i % anomaly_tables + 1}", 
+            dataset_table_column_name='table_id', 
+            entries_column_name='row_count', 
+            threshold=threshold, 
+            execution_mode=execution_mode, 
+            lookback_days=lookback_days
+        )
+        test_id += 1
+
+    for _ in range(data_arrived_tests):
+        add_row(test_id, 'data_arrived_or_not', f"events_{test_id}")
+        test_id += 1
+
+    for _ in range(no_of_rows_tests):
+        for table in range(tables_per_test):
+            add_row(test_id, 'no_of_rows', f"events_{test_id}_{table}")
+        test_id += 1
+
+    return pd.DataFrame(rows, columns=list(TEST_FIELDS))
+
+
+class SyntheticWarehouse:
+    # Answers the queries built by Utils from synthetic tables. Anomaly tables
+    # are series x days pivots generated from the table name, so results are
+    # the same on every run. query_latency adds a fixed delay per query, to
+    # stand in for the BigQuery job round trip. queries counts the queries
+    # executed.
+    def __init__(self, series=100, days=365, stale_ratio=0.1, query_latency=0, seed=0):
+        self.series = series
+        self.days = days
+        self.stale_ratio = stale_ratio
+        self.query_latency = query_latency
+        self.seed = seed
+        self.queries = 0
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _table_seed(self, table_name):
+        return self.seed + zlib.crc32(table_name.encode())
+
+    def get_long_table(self, table_name):
+        # (date, column_to_pivot_on, current_day_rows) rows, as the anomaly query selects them
+        with self._lock:
+            if table_name not in self._tables:
+                pivot_df = make_pivot(self.series, self.days, seed=self._table_seed(table_name))
+                self._tables[table_name] = pivot_df.stack().rename('current_day_rows').reset_index()
+
+            return self._tables[table_name]
+
+    def _table_is_stale(self, table_name):
+        return np.random.default_rng(self._table_seed(table_name)).random() < self.stale_ratio
+
+    def _anomaly_rows(self, query_script, table_name):
+        long_df = self.get_long_table(table_name)
+        start_date = re.search(r">= date '(\d{4}-\d{2}-\d{2})'", query_script)
+        lookback_days = re.search(r"interval (\d+) day", query_script)
+
+        if start_date is not None:
+            long_df = long_df[long_df['date'] >= date.fromisoformat(start_date.group(1))]
+        elif lookback_days is not None:
+            long_df = long_df[long_df['date'] >= self._first_date(lookback_days.group(1))]
+
+        return long_df
+
+    def _first_date(self, lookback_days):
+        return (pd.Timestamp.today().normalize() - pd.Timedelta(days=int(lookback_days))).date()
+
+    def _shared_scan_rows(self, query_script, table_name):
+        # Every test's series and entries columns of a shared scan are read
+        # from the same synthetic table
+        long_df = self.get_long_table(table_name)
+        scan_lookback = re.search(r"where \w+ >= date_sub\(current_date\(\), interval (\d+) day\)", query_script)
+
+        if scan_lookback is not None:
+            long_df = long_df[long_df['date'] >= self._first_date(scan_lookback.group(1))]
+
+        result_df = pd.DataFrame({'date': long_df['date'].to_numpy()})
+
+        for name in dict.fromkeys(re.findall(r"\b(series_\d+)\b", query_script)):
+            result_df[name] = long_df['column_to_pivot_on'].to_numpy()
+
+        for name in dict.fromkeys(re.findall(r"\b(entries_\d+)\b", query_script)):
+            result_df[name] = long_df['current_day_rows'].to_numpy()
+
+        for lookback_days, name in re.findall(r"interval (\d+) day\) (in_window_\d+)", query_script):
+            result_df[name] = result_df['date'] >= self._first_date(lookback_days)
+
+        return result_df
+
+    def execute(self, query_script):
+        with self._lock:
+            self.queries += 1
+
+        if self.query_latency > 0:
+            time.sleep(self.query_latency)
+
+        today = date.today()
+
+        if "INFORMATION_SCHEMA" in query_script:
+            table_name = re.search(r"table_name = '([^']+)'", query_script).group(1)
+
+            return pd.DataFrame({
+                'partitioning_column': ['date'], 
+                'last_entry_date': [None if self._table_is_stale(table_name) else today], 
+                'no_of_rows': [np.random.default_rng(self._table_seed(table_name)).integers(0, 100000)], 
+                'unpartitioned_rows': [0], 
+                'coarse_partitions': [0]
+            })
+
+        table_name = re.search(r"from\s+`?([\w\-]+\.[\w\-]+\.[\w\-]+)`?", query_script).group(1).split('.')[-1]
+
+        if "percentile_cont" in query_script:
+            # Pushdown: the same fence rule, computed in Python over the window
+            threshold = float(re.search(r"percentile_cont\(current_day_rows, ([0-9.e\-]+)\)", query_script).group(1)) * 100
+            long_df = self._anomaly_rows(query_script, table_name)
+            anomalies_df = Utils().detect_anomalies(
+                long_df.pivot_table(index='date', columns='column_to_pivot_on', values='current_day_rows'), 
+                threshold
+            )
+
+            return pd.DataFrame({
+                'column_to_pivot_on': anomalies_df.get('dataset|table', pd.Series(dtype=object)), 
+                'current_day_rows': anomalies_df.get("today's rows", pd.Series(dtype=np.float64)), 
+                'q1': anomalies_df.get('10%', pd.Series(dtype=np.float64)), 
+                'q2': anomalies_df.get('90%', pd.Series(dtype=np.float64))
+            })
+
+        if "column_to_pivot_on" in query_script:
+            return self._anomaly_rows(query_script, table_name)
+
+        if re.search(r"\bseries_\d+\b", query_script):
+            return self._shared_scan_rows(query_script, table_name)
+
+        if "last_entry_date" in query_script:
+            last_entry_date = today - timedelta(days=1) if self._table_is_stale(table_name) else today
+            return pd.DataFrame({'last_entry_date': [last_entry_date]})
+
+        if "no_of_rows" in query_script:
+            return pd.DataFrame({'no_of_rows': [np.random.default_rng(self._table_seed(table_name)).integers(0, 100000)]})
+
+        raise ValueError(f"SyntheticWarehouse can't answer query: {query_script}")
+
+    def estimate_bytes(self, query_script):
+        if "column_to_pivot_on" in query_script and "INFORMATION_SCHEMA" not in query_script:
+            # date + series name + count per row
+            return int(self.series * self.days * 24)
+
+        return 10 * 1024 * 1024
+
+
+class FakeRowIterator:
+    # The parts of google.cloud.bigquery's RowIterator used by Utils
+    def __init__(self, query_result_df, page_rows=100000):
+        self.query_result_df = query_result_df
+        self.page_rows = page_rows
+        self.total_rows = query_result_df.shape[0]
+
+    def to_dataframe(self, bqstorage_client=None, create_bqstorage_client=True, progress_bar_type=None):
+        return self.query_result_df.reset_index(drop=True)
+
+    def to_dataframe_iterable(self, bqstorage_client=None):
+        for start in range(0, max(self.total_rows, 1), self.page_rows):
+            yield self.query_result_df.iloc[start:start + self.page_rows].reset_index(drop=True)
+
+
+class FakeCredentials:
+    token = None
+    expiry = None
+    project_id = 'fake-project'
+
+
+class FakeUtils(Utils):
+    # Utils with the Google calls answered by a SyntheticWarehouse and a sheet
+    # fixture. Query building, fetching, pivoting and detection are the real
+    # Utils code.
+    def __init__(self, warehouse=None, sheet_df=None):
+        super().__init__()
+        self.warehouse = warehouse if warehouse is not None else SyntheticWarehouse()
+        self.sheet_df = sheet_df if sheet_df is not None else make_test_sheet()
+        self.sheet_revision = "1"
+        self.credentials = FakeCredentials()
+
+    def get_credentials_with_scopes(self, read_from_local_service_account=False):
+        return self.credentials
+
+    def get_scheduler_credentials_with_scopes(self, read_from_local_service_account=False):
+        return self.credentials
+
+    def get_sheet_revision(self, credentials):
+        return self.sheet_revision
+
+    def get_sheet_as_df(self, credentials, range):
+        with metrics.span('sheets_read'):
+            return self.sheet_df.copy()
+
+    def get_bqstorage_client(self, credentials):
+        return None
+
+    def estimate_query_bytes(self, credentials, query_script, project_id):
+        return self.warehouse.estimate_bytes(query_script)
+
+    def run_query(self, credentials, query_script, project_id, maximum_bytes_billed=None):
+        bytes_processed = self.warehouse.estimate_bytes(query_script)
+
+        if maximum_bytes_billed is not None and bytes_processed > maximum_bytes_billed:
+            raise Exception(f"Query exceeded limit for bytes billed: {maximum_bytes_billed}")
+
+        with metrics.span('bigquery_job'):
+            query_result_df = self.warehouse.execute(query_script)
+
+        metrics.add('queries')
+        metrics.add('bytes_processed', bytes_processed)
+        metrics.add('bytes_billed', bytes_processed)
+
+        return FakeRowIterator(query_result_df)
+
+
+class _SinkHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        sink = self.server.sink
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if sink.latency > 0:
+            time.sleep(sink.latency)
+
+        with sink.lock:
+            sink.requests += 1
+            sink.bytes_received += len(body)
+            request_number = sink.requests
+
+        # GitLab's upload API answers with the path of the uploaded file, the
+        # Slack webhook with "ok"
+        if '/uploads' in self.path:
+            response = json.dumps({'full_path': f"/uploads/{request_number}/Test.png"}).encode()
+        else:
+            response = b"ok"
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalHTTPSink:
+    # Local HTTP server standing in for the Slack webhook and the GitLab
+    # upload API. It accepts any POST, counts requests and bytes, and can add
+    # a fixed latency per request. Use as a context manager; url is the base
+    # URL to point SLACK_WEBHOOK_URL / GITLAB_URL at.
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.requests = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        self._server = None
+
+    def __enter__(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _SinkHandler)
+        self._server.daemon_threads = True
+        self._server.sink = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self._server.shutdown()
+        self._server.server_close()
+        return False
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+
+class _SMTPSinkHandler(StreamRequestHandler):
+    # Just enough of SMTP for smtplib: EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT,
+    # DATA, RSET, NOOP and QUIT
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        sink = self.server.sink
+
+        if sink.connect_latency > 0:
+            time.sleep(sink.connect_latency)
+
+        with sink.lock:
+            sink.connections += 1
+
+        self.reply("220 localhost ESMTP sink")
+
+        while True:
+            line = self.rfile.readline()
+
+            if not line:
+                return
+
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+
+            if sink.latency > 0:
+                time.sleep(sink.latency)
+
+            if verb in ("EHLO", "HELO"):
+                self.wfile.write(b"250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250 SIZE 52428800\r\n")
+            elif verb == "AUTH":
+                if command.upper().startswith("AUTH LOGIN"):
+                    # Username and password each come on their own line
+                    for prompt in ("334 VXNlcm5hbWU6", "334 UGFzc3dvcmQ6"):
+                        self.reply(prompt)
+                        self.rfile.readline()
+
+                with sink.lock:
+                    sink.logins += 1
+
+                self.reply("235 2.7.0 Authentication successful")
+            elif verb == "MAIL":
+                with sink.lock:
+                    transient_failure = sink.transient_failures > 0
+                    sink.transient_failures -= transient_failure
+
+                self.reply("451 4.3.0 Try again later" if transient_failure else "250 OK")
+            elif verb == "RCPT":
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+
+                    size += len(data_line)
+
+                with sink.lock:
+                    sink.messages += 1
+                    sink.bytes_received += size
+
+                self.reply("250 OK queued")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class LocalSMTPSink:
+    # Local plain-text SMTP server standing in for the mail server. It
+    # accepts any login and message, and counts connections, logins,
+    # messages and bytes. connect_latency is added per connection, to stand
+    # in for the TCP/TLS handshake, latency per command, and the first
+    # transient_failures MAIL commands get a 451 reply. Use as a context
+    # manager and point SMTP_HOST/SMTP_PORT at host/port with SMTP_USE_SSL=false.
+    def __init__(self, latency=0, connect_latency=0, transient_failures=0):
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.transient_failures = transient_failures
+        self.connections = 0
+        self.logins = 0
+        self.messages = 0
+        self.bytes_received = 0
+        self.lock = threading.Lock()
+        self._server = None
+
+    def __enter__(self):
+        self._server = ThreadingTCPServer(('127.0.0.1', 0), _SMTPSinkHandler)
+        self._server.daemon_threads = True
+        self._server.sink = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self._server.shutdown()
+        self._server.server_close()
+        return False
+
+    @property
+    def host(self):
+        return '127.0.0.1'
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+
+class _FakeRequest:
+    def __init__(self, service, function, *args):
+        self.service = service
+        self.function = function
+        self.args = args
+
+    def execute(self, num_retries=0):
+        if self.service.latency > 0:
+            time.sleep(self.service.latency)
+
+        with self.service.lock:
+            self.service.calls += 1
+            return self.function(*self.args)
+
+
+class _FakeJobsResource:
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, parent, pageSize=500):
+        return _FakeRequest(self.service, self.service._list, parent, pageSize, 0)
+
+    def list_next(self, previous_request, previous_response):
+        if previous_response.get("nextPageToken") is None:
+            return None
+
+        parent, page_size, _ = previous_request.args
+        return _FakeRequest(self.service, self.service._list, parent, page_size, int(previous_response["nextPageToken"]))
+
+    def get(self, name):
+        return _FakeRequest(self.service, self.service._get, name)
+
+    def create(self, parent, body):
+        return _FakeRequest(self.service, self.service._put, body)
+
+    def patch(self, name, body):
+        return _FakeRequest(self.service, self.service._put, dict(body, name=name))
+
+    def delete(self, name):
+        return _FakeRequest(self.service, self.service.scheduled_jobs.pop, name, None)
+
+
+class FakeSchedulerService:
+    # In-memory Cloud Scheduler jobs API, shaped like the discovery client's
+    # projects().locations().jobs() resource (the service itself stands in
+    # for the projects and locations levels). latency adds a fixed delay per
+    # API call. Safe to share between threads.
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.scheduled_jobs = {}
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def projects(self):
+        return self
+
+    def locations(self):
+        return self
+
+    def jobs(self):
+        return _FakeJobsResource(self)
+
+    def _list(self, parent, page_size, offset):
+        names = sorted(name for name in self.scheduled_jobs if name.startswith(parent + "/jobs/"))
+        response = {"jobs": [self.scheduled_jobs[name] for name in names[offset:offset + page_size]]}
+
+        if offset + page_size < len(names):
+            response["nextPageToken"] = str(offset + page_size)
+
+        return response
+
+    def _get(self, name):
+        if name not in self.scheduled_jobs:
+            from googleapiclient.errors import HttpError
+            from httplib2 import Response
+
+            raise HttpError(Response({'status': 404}), b'{"error": {"code": 404}}')
+
+        return self.scheduled_jobs[name]
+
+    def _put(self, body):
+        # The API accepts snake_case bodies and answers in camelCase
+        job = {
+            "name": body["name"], 
+            "schedule": body["schedule"], 
+            "timeZone": body["time_zone"], 
+            "httpTarget": {"uri": body["http_target"]["uri"]}
+        }
+        self.scheduled_jobs[job["name"]] = job
+        return job
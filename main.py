@@ -1,7 +1,19 @@
 from datetime import datetime
-from utils import Utils
-from alerts import Slack
+from functools import partial
+from utils import Utils, client_cache
+from config_store import get_config_store
+from anomaly_state import AnomalyStateStore, merge_state_pivot, DEFAULT_WINDOW_DAYS
+from alerts import Slack, AlertQueue
+from alert_cache import AlertCache
+from run_history import RunHistoryStore
+from shared_scan import plan_shared_scans
+from metrics import RunMetrics
+import metrics
+from concurrent.futures import ThreadPoolExecutor
+import json
+import traceback
 import os
+import time
 import pandas as pd
 
 def get_anomalies(request):
@@ -10,177 +22,421 @@ def get_anomalies(request):
     print(f"Query Params: {query_params}")
 
     test_id = query_params.get("test_id", None)
+    rebuild_state = query_params.get("rebuild_state", "false").lower() == "true"
+    # profile=true (or ANOMA_PROFILE=true) prints a cProfile of this invocation
+    profile = query_params.get("profile", "false").lower() == "true" or None
 
+    if query_params.get("invalidate_cache", "false").lower() == "true":
+        client_cache.invalidate()
+
+    with metrics.profiled(profile), RunMetrics('test_run', test_id=str(test_id)) as run_metrics:
+        utils = Utils()
+        credentials = utils.get_credentials_with_scopes()
+
+        print(f"Client cache: {client_cache.get_stats()}")
+
+        with metrics.span('config'):
+            test_rows = get_config_store().get_test(utils, credentials, test_id)
+
+        if len(test_rows) < 1:
+            run_metrics.update(status="error")
+            return "No test available with given test_id"
+
+        run_metrics.update(test_name=test_rows[0].test_name, test_type=test_rows[0].test_type)
+
+        result = run_test(test_rows, utils, credentials, rebuild_state=rebuild_state)
+        run_metrics.update(status="ok")
+
+        return result
+
+
+def run_tests(request):
+    # Batch entry point: runs every test of a schedule slot (?schedule=<cron>
+    # and &timezone=, left out for tests without a timezone) or an explicit
+    # ?test_ids=1,2,3 list in one invocation, sharing credentials, clients and
+    # config between tests
+    query_params = request.args
+
+    print(f"Query Params: {query_params}")
+
+    profile = query_params.get("profile", "false").lower() == "true" or None
+
+    if query_params.get("invalidate_cache", "false").lower() == "true":
+        client_cache.invalidate()
+
+    with metrics.profiled(profile), RunMetrics('batch_run') as run_metrics:
+        utils = Utils()
+        credentials = utils.get_credentials_with_scopes()
+
+        print(f"Client cache: {client_cache.get_stats()}")
+
+        with metrics.span('config'):
+            tests = get_config_store().get_all_tests(utils, credentials)
+
+        if query_params.get("test_ids", None) is not None:
+            test_ids = [test_id.strip() for test_id in query_params.get("test_ids").split(",") if test_id.strip() != ""]
+        else:
+            schedule = query_params.get("schedule", None)
+            # Blank sheet cells are parsed as None, so a slot without a
+            # timezone only matches the tests without one
+            timezone = query_params.get("timezone", "") or None
+
+            test_ids = [
+                test_id for test_id, test_rows in tests.items() 
+                if schedule is not None and test_rows[0].cron_schedule == schedule and \
+                    test_rows[0].timezone == timezone
+            ]
+
+        with metrics.span('tests'):
+            summary = run_selected_tests(tests, test_ids, utils, credentials)
+
+        run_metrics.update(tests=len(test_ids), succeeded=summary["succeeded"], failed=summary["failed"])
+
+        return json.dumps(summary)
+
+
+def run_test_with_status(test_id, test_rows, utils, credentials, rebuild_state=False, dry_run=False, alert_queue=None, 
+                            run_metrics=None, shared_scan=None):
+    # The test's run metrics are emitted when it finishes, unless the caller
+    # passes its own run_metrics to emit later (e.g. once queued alerts are delivered)
+    status = {
+        "test_id": str(test_id), 
+        "test_name": test_rows[0].test_name if len(test_rows) > 0 else None, 
+        "test_type": test_rows[0].test_type if len(test_rows) > 0 else None
+    }
+
+    if run_metrics is None:
+        run_metrics = RunMetrics('test_run')
+
+    start = time.perf_counter()
+
+    with run_metrics:
+        if len(test_rows) < 1:
+            status.update({"status": "error", "result": "No test available with given test_id"})
+        else:
+            try:
+                status.update({
+                    "status": "ok", 
+                    "result": run_test(
+                        test_rows, utils, credentials, rebuild_state=rebuild_state, dry_run=dry_run, alert_queue=alert_queue, 
+                        shared_scan=shared_scan
+                    )
+                })
+            except Exception as e:
+                print(f"Test {test_id} failed: {traceback.format_exc()}")
+                status.update({"status": "error", "result": str(e)})
+
+        status["seconds"] = round(time.perf_counter() - start, 3)
+        run_metrics.update(**status)
+
+    return status
+
+
+def summarize_statuses(statuses):
+    summary = {
+        "tests": statuses, 
+        "succeeded": sum(status["status"] == "ok" for status in statuses), 
+        "failed": sum(status["status"] != "ok" for status in statuses)
+    }
+
+    print(f"Ran {len(statuses)} tests: {summary['succeeded']} succeeded, {summary['failed']} failed")
+
+    return summary
+
+
+def run_selected_tests(tests, test_ids, utils, credentials, rebuild_state=False):
+    max_workers = int(os.environ.get("ANOMA_MAX_TEST_WORKERS", 4))
+    statuses = []
+
+    if len(test_ids) > 0:
+        alert_queue = AlertQueue(max_workers=max_workers)
+        runs_metrics = [RunMetrics('test_run', emit=False) for _ in test_ids]
+        # Anomaly tests reading the same table share one query
+        shared_scans = plan_shared_scans(tests, test_ids)
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(test_ids))) as executor:
+            statuses = list(executor.map(
+                lambda test_id, run_metrics: run_test_with_status(
+                    test_id, tests.get(str(test_id), ()), utils, credentials, 
+                    rebuild_state=rebuild_state, alert_queue=alert_queue, run_metrics=run_metrics, 
+                    shared_scan=shared_scans.get(str(test_id), None)
+                ), 
+                test_ids, 
+                runs_metrics
+            ))
+
+        failed_alerts = alert_queue.shutdown()
+
+        if len(failed_alerts) > 0:
+            print(f"{len(failed_alerts)} alerts couldn't be delivered")
+
+        # A test whose alert never reached Slack didn't do its job
+        failed_alert_test_ids = {str(test_id) for test_id, _ in failed_alerts}
+
+        for status, run_metrics in zip(statuses, runs_metrics):
+            if status["status"] == "ok" and status["test_id"] in failed_alert_test_ids:
+                status.update({"status": "error", "result": f"{status['result']}, but its alert couldn't be delivered"})
+                run_metrics.update(**status)
+
+        # Emitted after the queue is drained, so they include alert delivery
+        for run_metrics in runs_metrics:
+            run_metrics.emit()
+
+    return summarize_statuses(statuses)
+
+
+def run_test(test_rows, utils, credentials, rebuild_state=False, dry_run=False, alert_queue=None, shared_scan=None):
     git_project_id = os.environ.get("GIT_PROJECT_ID", None)
     git_token = os.environ.get("GIT_TOKEN", None)
-    
-    utils = Utils()
-    credentials = utils.get_credentials_with_scopes()
 
-    queries_df = utils.get_sheet_as_df(credentials, "queries")
-    sliced_queries_df = queries_df[queries_df['test_id'] == str(test_id)]
+    test = test_rows[0]
+    test_type = test.test_type
+    test_name = test.test_name
+    slack_member_id = test.slack_member_id
 
-    if sliced_queries_df.shape[0] < 1:
-        return "No test available with given test_id"
+    slack = Slack(dry_run=dry_run, alert_cache=AlertCache(utils, credentials))
 
-    test_type = sliced_queries_df['test_type'].iloc[0]
-    test_name = sliced_queries_df['test_name'].iloc[0]
-    slack_member_id = sliced_queries_df['slack_member_id'].iloc[0]
+    # Dry runs aren't recorded, like they aren't cached
+    history_store = RunHistoryStore()
+    record_history = history_store.enabled and not dry_run
+
+    # With an alert_queue the alert is delivered in the background and the
+    # caller waits for the queue once all its tests have run
+    def send_alert(message, df=None):
+        if alert_queue is not None:
+            alert_queue.submit(slack, message, df, git_project_id, git_token, test.render_mode, test.test_id)
+        else:
+            slack.send_alert(message, df, git_project_id, git_token, test.render_mode, test.test_id)
 
     if test_type == 'anomaly':
-        query = utils.construct_query_for_test(
-            main_table_name=sliced_queries_df['main_table_name'].iloc[0], 
-            date_column_name=sliced_queries_df['date_column_name'].iloc[0],
-            dataset_column_name=sliced_queries_df['dataset_column_name'].iloc[0],
-            dataset_table_column_name=sliced_queries_df['dataset_table_column_name'].iloc[0],
-            entries_column_name=sliced_queries_df['entries_column_name'].iloc[0], 
-            test_type=test_type
-        )
+        state_store = None
+        state_pivot = None
+        window_days = test.lookback_days if test.lookback_days is not None else DEFAULT_WINDOW_DAYS
+
+        if test.execution_mode == 'incremental':
+            state_store = AnomalyStateStore()
+
+            # Without a state (or when asked to rebuild it) the full window is
+            # fetched, otherwise only the days from the last stored day onwards
+            if not rebuild_state:
+                with metrics.span('state_load'):
+                    state_pivot = state_store.load(utils, credentials, test.test_id)
+
+        # Tests sharing a scan take their rows from one query for the whole
+        # group, planned by run_selected_tests
+        if shared_scan is None:
+            query = utils.construct_query_for_test(
+                main_table_name=test.main_table_name, 
+                date_column_name=test.date_column_name,
+                dataset_column_name=test.dataset_column_name,
+                dataset_table_column_name=test.dataset_table_column_name,
+                entries_column_name=test.entries_column_name, 
+                test_type=test_type, 
+                lookback_days=window_days if state_store is not None else test.lookback_days, 
+                start_date=None if state_pivot is None else state_pivot.index[-1].strftime("%Y-%m-%d")
+            )
 
-        query_result_df = utils.get_query_results_as_df(
-            credentials=credentials, 
-            query_script=query, 
-            project_id=sliced_queries_df['project_name'].iloc[0]
-        )
+            if test.execution_mode == 'pushdown':
+                query = utils.construct_pushdown_anomaly_query(
+                    query, 
+                    date_column_name=test.date_column_name, 
+                    threshold=test.threshold
+                )
 
-        if "column_to_pivot_on" in list(query_result_df.columns):
-            pivot_df = query_result_df.pivot_table(
-                index='date', 
-                columns = 'column_to_pivot_on',
-                values = 'current_day_rows'
+            _, within_budget = utils.check_bytes_budget(
+                credentials=credentials, 
+                query_script=query, 
+                project_id=test.project_name, 
+                max_bytes_processed=test.max_bytes_processed, 
+                bytes_budget_action=test.bytes_budget_action
             )
-        else:
-            pivot_df = query_result_df
 
-        anomalies = pivot_df.apply(
-            utils.get_last_anomalous, 
-            axis=0, 
-            threshold=float(sliced_queries_df['threshold'].iloc[0])
-        )
+            if not within_budget:
+                return f"Query for {test_name} exceeds its bytes budget of {test.max_bytes_processed}, not run"
 
-        quartiles_df = utils.check_anomaly(anomalies)
+            maximum_bytes_billed = test.max_bytes_processed if test.bytes_budget_action == 'refuse' else None
 
-        slack = Slack()
+        if test.execution_mode == 'pushdown':
+            query_result_df = utils.get_query_results_as_df(
+                credentials=credentials, 
+                query_script=query, 
+                project_id=test.project_name, 
+                maximum_bytes_billed=maximum_bytes_billed
+            )
+
+            with metrics.span('detection'):
+                # Only the anomalous series come back from the warehouse, so
+                # only those are recorded
+                quartiles_df = utils.pushdown_result_to_anomalies(query_result_df)
+                series_df = quartiles_df
+        elif test.execution_mode == 'compact':
+            # Result pages are fetched while they're compacted, so the 'pivot'
+            # span includes the fetch
+            with metrics.span('pivot'):
+                compact_result = utils.get_compact_result(
+                    credentials=credentials, 
+                    query_script=query, 
+                    project_id=test.project_name, 
+                    maximum_bytes_billed=maximum_bytes_billed
+                )
+
+            metrics.add('series', len(compact_result[1]))
+
+            with metrics.span('detection'):
+                series_df = utils.detect_anomalies_compact(
+                    compact_result, 
+                    threshold=test.threshold, 
+                    all_series=record_history
+                )
+                quartiles_df = utils.anomalous_series(series_df)
+        else:
+            if shared_scan is not None:
+                pivot_df = shared_scan.get_pivot(utils, credentials, test.test_id)
+            else:
+                pivot_df = utils.get_anomaly_pivot(
+                    credentials=credentials, 
+                    query_script=query, 
+                    project_id=test.project_name, 
+                    maximum_bytes_billed=maximum_bytes_billed, 
+                    stream=test.execution_mode == 'streaming'
+                )
+
+            if state_store is not None:
+                with metrics.span('state_save'):
+                    pivot_df = merge_state_pivot(state_pivot, pivot_df, window_days)
+
+                    # Without any day there's nothing to resume from, so the
+                    # next run queries the full window again
+                    if pivot_df.shape[0] > 0:
+                        state_store.save(utils, credentials, test.test_id, pivot_df)
+
+            metrics.add('series', pivot_df.shape[1])
+
+            with metrics.span('detection'):
+                series_df = utils.detect_anomalies(
+                    pivot_df, 
+                    threshold=test.threshold, 
+                    all_series=record_history
+                )
+                quartiles_df = utils.anomalous_series(series_df)
+
+        metrics.add('anomalies_found', quartiles_df.shape[0])
+
+        if record_history:
+            with metrics.span('history'):
+                history_store.record_anomaly_series(test.test_id, series_df, test.threshold)
 
         if quartiles_df.shape[0] == 0:
-            slack.send_message_via_webhook(
+            send_alert(
                 f"Anomly test successfully run for {test_name}, " + \
-                "No Anomalies detected", 
-                image=None
+                "No Anomalies detected"
             )    
         else:
-            image_buffer = slack.df_to_image_buffer(quartiles_df)
-            jsn = slack.upload_image_to_gitlab(git_project_id, 
-                "Test.png",
-                image_buffer,
-                git_token
-            )
-
-            print('Image Url: ' + 'https://gitlab.com'+jsn['full_path'])
-
-            slack.send_message_via_webhook(
+            send_alert(
                 f"Hey, <@{slack_member_id}>! Anomly test successfully run for {test_name}, " + \
                 "Anomalies detected, run query for the test to see more", 
-                image='https://gitlab.com'+jsn['full_path']
+                df=quartiles_df
             )  
 
         return "Executed successfully"
     
     elif test_type == 'data_arrived_or_not':
-        query = utils.construct_query_for_test(
-            main_table_name=sliced_queries_df['main_table_name'].iloc[0],
-            date_column_name=sliced_queries_df['date_column_name'].iloc[0],
-            test_type=test_type
-        )
-
-        query_result_df = utils.get_query_results_as_df(
+        query_result_df, check_path = utils.run_table_check(
             credentials=credentials, 
-            query_script=query, 
-            project_id=sliced_queries_df['project_name'].iloc[0]
+            project_id=test.project_name, 
+            main_table_name=test.main_table_name, 
+            date_column_name=test.date_column_name, 
+            test_type=test_type, 
+            use_partition_metadata=test.use_partition_metadata
         )
 
-        slack = Slack()
+        metrics.add(f'table_checks_{check_path}')
 
         print(query_result_df['last_entry_date'].iloc[0])
         print(datetime.today().date().strftime("%Y-%m-%d"))
 
+        if record_history:
+            with metrics.span('history'):
+                history_store.record_table_checks(test.test_id, test_type, [(
+                    test.main_table_name, 
+                    query_result_df['no_of_rows'].iloc[0] if 'no_of_rows' in query_result_df.columns else None, 
+                    query_result_df['last_entry_date'].iloc[0], 
+                    None
+                )])
+
         if str(query_result_df['last_entry_date'].iloc[0]) == datetime.today().date().strftime("%Y-%m-%d"):
-            slack.send_message_via_webhook(
-                message=f"Test successfully run for {test_name}, " + \
-                "Data has been collected", 
-                image=None, 
+            send_alert(
+                f"Test successfully run for {test_name}, " + \
+                "Data has been collected"
             )
         else:
-            image_buffer = slack.df_to_image_buffer(query_result_df)
-            jsn = slack.upload_image_to_gitlab(git_project_id, 
-                "Test.png",
-                image_buffer,
-                git_token
-            )
-
-            print('https://gitlab.com'+jsn['full_path'])
-
-            slack.send_message_via_webhook(
-                message=f"Hey, <@{slack_member_id}>! Test successfully run for {test_name}, " + \
+            send_alert(
+                f"Hey, <@{slack_member_id}>! Test successfully run for {test_name}, " + \
                 "Data has not been collected", 
-                image='https://gitlab.com'+jsn['full_path'], 
+                df=query_result_df
             )
 
         return "Executed Successfully"
     elif test_type == "no_of_rows":
-        rows = 0
-        grouped_query_results_df = pd.DataFrame()
-        zero_row_found = False
-
-        for i in range(sliced_queries_df.shape[0]):
-            query = utils.construct_query_for_test(
-                main_table_name=sliced_queries_df['main_table_name'].iloc[i],
-                date_column_name=sliced_queries_df['date_column_name'].iloc[i],
-                test_type=test_type
-            )
-
-            query_result_df = utils.get_query_results_as_df(
+        query_results = utils.run_concurrently([
+            partial(
+                utils.run_table_check, 
                 credentials=credentials, 
-                query_script=query, 
-                project_id=sliced_queries_df['project_name'].iloc[0]
-            )
-
-            print(f"Query {i}: {query_result_df}")
-
-            grouped_query_results_df = grouped_query_results_df.append(pd.DataFrame({
-                'dataset/table': [sliced_queries_df['main_table_name'].iloc[i].split('.')[1]], 
-                'no_of_rows': [query_result_df['no_of_rows'].iloc[0]]
-            }))
-
-            if query_result_df['no_of_rows'].iloc[0] == 0:
-                zero_row_found = True
-
-            rows += query_result_df['no_of_rows'].iloc[0]
+                project_id=test.project_name, 
+                main_table_name=test_row.main_table_name, 
+                date_column_name=test_row.date_column_name, 
+                test_type=test_type, 
+                use_partition_metadata=test_row.use_partition_metadata
+            ) for test_row in test_rows
+        ])
+
+        table_names = []
+        table_rows = []
+        failed_tables = []
+
+        for i, (test_row, (table_check, error)) in enumerate(zip(test_rows, query_results)):
+            print(f"Query {i}: {table_check if error is None else error}")
+
+            table_names.append(test_row.main_table_name.split('.')[1])
+
+            if error is None:
+                query_result_df, check_path = table_check
+                metrics.add(f'table_checks_{check_path}')
+                table_rows.append(query_result_df['no_of_rows'].iloc[0])
+            else:
+                table_rows.append(None)
+                failed_tables.append(test_row.main_table_name)
+
+        grouped_query_results_df = pd.DataFrame({
+            'dataset/table': table_names, 
+            'no_of_rows': table_rows
+        })
+
+        rows = sum(row for row in table_rows if row is not None)
+        zero_row_found = any(row == 0 for row in table_rows) or len(failed_tables) > 0
+        failed_message = f", Failed to count rows for: {', '.join(failed_tables)}" if len(failed_tables) > 0 else ""
 
         print(f"Total Rows: {rows}")
-        print(f"Grouped DataFrame: {grouped_query_results_df}")
-
-        slack = Slack()
-        
-        image_buffer = slack.df_to_image_buffer(grouped_query_results_df)
 
-        jsn = slack.upload_image_to_gitlab(git_project_id, 
-            "Test.png",
-            image_buffer,
-            git_token
-        )
+        if record_history:
+            with metrics.span('history'):
+                history_store.record_table_checks(test.test_id, test_type, [
+                    (test_row.main_table_name, table_row, None, None if error is None else str(error))
+                    for test_row, table_row, (_, error) in zip(test_rows, table_rows, query_results)
+                ])
+        print(f"Grouped DataFrame: {grouped_query_results_df}")
 
         if zero_row_found:
-            slack.send_message_via_webhook(
-                message=f"Hey, <@{slack_member_id}>! Test successfully run for {test_name}, " + \
-                f"Total no. of rows collected today: {rows}", 
-                image='https://gitlab.com'+jsn['full_path'], 
+            send_alert(
+                f"Hey, <@{slack_member_id}>! Test successfully run for {test_name}, " + \
+                f"Total no. of rows collected today: {rows}{failed_message}", 
+                df=grouped_query_results_df
             )
         else:
-            slack.send_message_via_webhook(
-                message=f"Test successfully run for {test_name}, " + \
+            send_alert(
+                f"Test successfully run for {test_name}, " + \
                 f"Total no. of rows collected today: {rows}", 
-                image='https://gitlab.com'+jsn['full_path'], 
+                df=grouped_query_results_df
             )            
 
         return "Executed Successfully"
@@ -188,5 +444,245 @@ def get_anomalies(request):
         return "test_type isn't configured correct. Check again!"
 
 
+
+DEFAULT_BACKTEST_THRESHOLDS = [1, 2.5, 5, 10, 15, 20, 25]
+
+
+def backtest_test(test_rows, utils, credentials, thresholds, backtest_days=365):
+    # Replays an anomaly test's fence rule over the last backtest_days days
+    # for each threshold, fetching enough extra days for the first evaluated
+    # day to have its full lookback_days of history, or the whole table when
+    # lookback_days is blank, as a live run would. Only the last
+    # backtest_days days are counted. Returns one row per threshold with the
+    # test's alert rate.
+    test = test_rows[0]
+
+    if test.test_type != 'anomaly':
+        raise ValueError(f"{test.test_id} is a {test.test_type} test, only anomaly tests can be backtested")
+
+    query = utils.construct_query_for_test(
+        main_table_name=test.main_table_name, 
+        date_column_name=test.date_column_name,
+        dataset_column_name=test.dataset_column_name,
+        dataset_table_column_name=test.dataset_table_column_name,
+        entries_column_name=test.entries_column_name, 
+        test_type=test.test_type, 
+        lookback_days=None if test.lookback_days is None else backtest_days + test.lookback_days
+    )
+
+    pivot_df = utils.get_anomaly_pivot(
+        credentials=credentials, 
+        query_script=query, 
+        project_id=test.project_name
+    )
+
+    metrics.add('series', pivot_df.shape[1])
+
+    with metrics.span('backtest'):
+        backtest_df = utils.backtest_thresholds(
+            pivot_df, 
+            thresholds, 
+            window_days=test.lookback_days, 
+            evaluate_from=pd.Timestamp(datetime.now().date()) - pd.Timedelta(days=backtest_days - 1)
+        )
+
+    backtest_df.insert(0, 'test_id', test.test_id)
+    backtest_df.insert(1, 'series', pivot_df.shape[1])
+    backtest_df['current_threshold'] = test.threshold
+
+    return backtest_df
+
+
+# Per-process state of the CLI worker pool, set up once by _init_cli_worker
+_cli_worker = {}
+
+
+def _init_cli_worker(dry_run):
+    utils = Utils()
+    _cli_worker.update({
+        "utils": utils, 
+        "credentials": utils.get_credentials_with_scopes(), 
+        "dry_run": dry_run
+    })
+
+
+def _run_cli_test(test_id, test_rows):
+    return run_test_with_status(
+        test_id, 
+        test_rows, 
+        _cli_worker["utils"], 
+        _cli_worker["credentials"], 
+        dry_run=_cli_worker["dry_run"]
+    )
+
+
+def _run_cli_backtest(test_id, test_rows, thresholds, backtest_days):
+    start = time.perf_counter()
+
+    try:
+        backtest_df = backtest_test(
+            test_rows, 
+            _cli_worker["utils"], 
+            _cli_worker["credentials"], 
+            thresholds, 
+            backtest_days=backtest_days
+        )
+        rows = backtest_df.to_dict(orient="records")
+        status = "ok"
+        error = None
+    except Exception as e:
+        traceback.print_exc()
+        rows = []
+        status = "error"
+        error = str(e)
+
+    return {
+        "test_id": test_id, 
+        "status": status, 
+        "error": error, 
+        "seconds": round(time.perf_counter() - start, 3), 
+        "thresholds": rows
+    }
+
+
+def write_report(summary, report_path):
+    if report_path.endswith(".csv"):
+        pd.DataFrame(summary["tests"]).to_csv(report_path, index=False)
+    else:
+        with open(report_path, "w") as report_file:
+            json.dump(summary, report_file, indent=2, default=str)
+
+    print(f"Report written to {report_path}")
+
+
+def run_cli(argv=None):
+    # Runs configured tests locally, one test per worker process so the
+    # pivoting, detection and rendering of different tests use separate cores
+    import argparse
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = argparse.ArgumentParser(description="Run Anoma Bot tests locally")
+    parser.add_argument("--config-json", action="store_true", help="read tests from config.json instead of the sheet")
+    parser.add_argument("--test-ids", default=None, help="comma separated test ids to run (default: all)")
+    parser.add_argument("--test-type", default=None, help="only run tests of this test_type")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--report", default="anoma_bot_report.json", help="report path, .json or .csv")
+    parser.add_argument("--dry-run", action="store_true", help="don't upload images or post to Slack")
+    parser.add_argument("--backtest", action="store_true", help="report alert rates per threshold instead of running the tests")
+    parser.add_argument("--thresholds", default=",".join(str(threshold) for threshold in DEFAULT_BACKTEST_THRESHOLDS), 
+                        help="comma separated thresholds to backtest")
+    parser.add_argument("--backtest-days", type=int, default=365, help="number of past days to backtest")
+    parser.add_argument("--history-report", choices=["weekly", "monthly"], default=None, 
+                        help="summarize recorded run history instead of running the tests")
+    parser.add_argument("--history-periods", type=int, default=8, help="number of weeks or months to summarize")
+    args = parser.parse_args(argv)
+
+    if args.history_report is not None:
+        return run_cli_history_report(args)
+
+    utils = Utils()
+    credentials = utils.get_credentials_with_scopes()
+    tests = get_config_store(args.config_json).get_all_tests(utils, credentials)
+
+    test_ids = list(tests) if args.test_ids is None else \
+        [test_id.strip() for test_id in args.test_ids.split(",") if test_id.strip() != ""]
+
+    if args.test_type is not None:
+        test_ids = [test_id for test_id in test_ids if test_id in tests and tests[test_id][0].test_type == args.test_type]
+
+    if args.backtest:
+        return run_cli_backtest(args, tests, test_ids)
+
+    print(f"Running {len(test_ids)} tests on {args.workers} workers{' (dry run)' if args.dry_run else ''}")
+
+    statuses = []
+
+    if len(test_ids) > 0:
+        with ProcessPoolExecutor(
+            max_workers=min(args.workers, len(test_ids)), 
+            initializer=_init_cli_worker, 
+            initargs=(args.dry_run,)
+        ) as executor:
+            statuses = list(executor.map(
+                _run_cli_test, 
+                test_ids, 
+                [tests.get(test_id, ()) for test_id in test_ids]
+            ))
+
+    summary = summarize_statuses(statuses)
+    write_report(summary, args.report)
+
+    return summary
+
+
+def run_cli_history_report(args):
+    # Reads only the local run history, no credentials or warehouse queries needed
+    test_ids = None if args.test_ids is None else \
+        [test_id.strip() for test_id in args.test_ids.split(",") if test_id.strip() != ""]
+
+    history_store = RunHistoryStore()
+
+    if not history_store.enabled:
+        raise SystemExit("Set ANOMA_HISTORY_PATH to the run history database to report on")
+
+    start = time.perf_counter()
+    tables_df, anomalies_df = history_store.report(args.history_report, args.history_periods, test_ids=test_ids)
+    print(f"Built {args.history_report} history report in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    summary = {
+        "period": args.history_report, 
+        "periods": args.history_periods, 
+        "tables": tables_df.to_dict(orient="records"), 
+        "anomalies": anomalies_df.to_dict(orient="records")
+    }
+
+    if args.report.endswith(".csv"):
+        # One CSV with the table check and anomaly summaries stacked, told apart by 'kind'
+        report_df = pd.concat([tables_df.assign(kind="table_check"), anomalies_df.assign(kind="anomaly")], ignore_index=True)
+        report_df.to_csv(args.report, index=False)
+        print(f"Report written to {args.report}")
+    else:
+        write_report(summary, args.report)
+
+    return summary
+
+
+def run_cli_backtest(args, tests, test_ids):
+    from concurrent.futures import ProcessPoolExecutor
+
+    thresholds = [float(threshold) for threshold in args.thresholds.split(",") if threshold.strip() != ""]
+    test_ids = [test_id for test_id in test_ids if test_id in tests and tests[test_id][0].test_type == 'anomaly']
+
+    print(f"Backtesting {len(test_ids)} anomaly tests over {args.backtest_days} days at thresholds {thresholds}")
+
+    results = []
+
+    if len(test_ids) > 0:
+        with ProcessPoolExecutor(
+            max_workers=min(args.workers, len(test_ids)), 
+            initializer=_init_cli_worker, 
+            initargs=(True,)
+        ) as executor:
+            results = list(executor.map(
+                partial(_run_cli_backtest, thresholds=thresholds, backtest_days=args.backtest_days), 
+                test_ids, 
+                [tests[test_id] for test_id in test_ids]
+            ))
+
+    summary = {
+        "total": len(results), 
+        "errors": sum(result["status"] == "error" for result in results), 
+        "tests": [
+            {"test_id": result["test_id"], "status": result["status"], "error": result["error"], **row}
+            for result in results
+            for row in (result["thresholds"] or [{}])
+        ]
+    }
+
+    write_report(summary, args.report)
+
+    return summary
+
+
 if __name__ == '__main__':
-    print(get_anomalies(None))
+    run_cli()
@@ -0,0 +1,141 @@
+from contextlib import contextmanager
+from functools import partial
+import contextvars
+import json
+import os
+import threading
+import time
+
+
+_current_run = contextvars.ContextVar('anoma_bot_run_metrics', default=None)
+
+
+class RunMetrics:
+    # Collects stage timings and counters for one run (a test, a batch or a
+    # scheduler sync) and emits them as a single JSON log line. Used as a
+    # context manager, it becomes the current run for the code inside it, so
+    # metrics.span() and metrics.add() calls anywhere below record into it.
+    # Spans are summed per name; stages run on several threads (e.g. the
+    # table checks of a no_of_rows test) can add up to more than the wall time.
+    def __init__(self, event, emit=True, **fields):
+        self.event = event
+        self.emit_on_exit = emit
+        self.fields = dict(fields)
+        self.spans = {}
+        self.counters = {}
+        self.seconds = None
+        self._start = None
+        self._token = None
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._token = _current_run.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        _current_run.reset(self._token)
+        self.seconds = time.perf_counter() - self._start
+
+        if exc_type is not None:
+            self.update(status='error', error=str(exc_value))
+
+        if self.emit_on_exit:
+            self.emit()
+
+        return False
+
+    def update(self, **fields):
+        with self._lock:
+            self.fields.update(fields)
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            total, count = self.spans.get(name, (0, 0))
+            self.spans[name] = (total + seconds, count + 1)
+
+    def to_record(self):
+        with self._lock:
+            return {
+                "event": self.event,
+                **self.fields,
+                "seconds": None if self.seconds is None else round(self.seconds, 3),
+                "spans": {
+                    name: {"seconds": round(total, 3), "count": count}
+                    for name, (total, count) in self.spans.items()
+                },
+                "counters": dict(self.counters)
+            }
+
+    def emit(self):
+        # One line of JSON, which Cloud Logging parses into a structured entry
+        print(json.dumps(self.to_record(), default=str))
+
+
+@contextmanager
+def span(name):
+    run_metrics = _current_run.get()
+
+    if run_metrics is None:
+        yield
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        run_metrics.add_span(name, time.perf_counter() - start)
+
+
+def add(name, value=1):
+    run_metrics = _current_run.get()
+
+    if run_metrics is not None:
+        run_metrics.add(name, value)
+
+
+def bind(function):
+    # Worker threads don't inherit the caller's context, so functions handed
+    # to an executor are bound to a copy of it to keep recording into the
+    # current run
+    return partial(contextvars.copy_context().run, function)
+
+
+@contextmanager
+def profiled(enabled=None, top=30):
+    # Opt-in cProfile of one invocation, enabled by the caller or with
+    # ANOMA_PROFILE=true. The top functions by cumulative time are printed,
+    # and the raw stats are written to ANOMA_PROFILE_PATH when it's set.
+    if enabled is None:
+        enabled = os.environ.get("ANOMA_PROFILE", "false").lower() == "true"
+
+    if not enabled:
+        yield
+        return
+
+    import cProfile
+    import io
+    import pstats
+
+    profile = cProfile.Profile()
+    profile.enable()
+
+    try:
+        yield
+    finally:
+        profile.disable()
+
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(top)
+        print(output.getvalue())
+
+        profile_path = os.environ.get("ANOMA_PROFILE_PATH", None)
+
+        if profile_path is not None:
+            profile.dump_stats(profile_path)
+            print(f"Wrote profile to {profile_path}")
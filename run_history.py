@@ -0,0 +1,270 @@
+from datetime import datetime, timedelta
+import os
+import sqlite3
+import threading
+import pandas as pd
+
+
+# Rows are keyed by test and run day first, so a test's history is stored
+# contiguously (WITHOUT ROWID tables are clustered on their primary key) and
+# a rerun on the same day replaces that day's rows. anomaly_runs holds one
+# rollup row per anomaly run, so reports never scan the per-series rows
+# except for the (indexed) anomalous ones.
+SCHEMA = """
+    create table if not exists table_checks (
+        test_id text not null, 
+        run_date text not null, 
+        week text not null, 
+        month text not null, 
+        table_name text not null, 
+        test_type text not null, 
+        run_at text not null, 
+        no_of_rows integer, 
+        last_entry_date text, 
+        error text, 
+        primary key (test_id, run_date, table_name)
+    ) without rowid;
+
+    create table if not exists anomaly_series (
+        test_id text not null, 
+        run_date text not null, 
+        week text not null, 
+        month text not null, 
+        series text not null, 
+        run_at text not null, 
+        value real, 
+        q1 real, 
+        q2 real, 
+        threshold real, 
+        anomaly integer not null, 
+        primary key (test_id, run_date, series)
+    ) without rowid;
+
+    create table if not exists anomaly_runs (
+        test_id text not null, 
+        run_date text not null, 
+        week text not null, 
+        month text not null, 
+        run_at text not null, 
+        threshold real, 
+        series integer, 
+        anomalies integer not null, 
+        total_value real, 
+        primary key (test_id, run_date)
+    ) without rowid;
+
+    create index if not exists table_checks_run_date on table_checks (run_date);
+    create index if not exists anomaly_runs_run_date on anomaly_runs (run_date);
+    create index if not exists anomaly_series_anomalies on anomaly_series (run_date, test_id, week, month, series, anomaly) where anomaly = 1;
+"""
+
+# Every row carries the first day of its run's week (Monday) and month, so
+# reports group on a stored column rather than computing dates per row
+PERIOD_COLUMNS = {
+    "weekly": "week", 
+    "monthly": "month"
+}
+
+
+def _run_periods(run_at):
+    run_date = run_at.date()
+    return (
+        run_date.isoformat(), 
+        (run_date - timedelta(days=run_date.weekday())).isoformat(), 
+        run_date.replace(day=1).isoformat()
+    )
+
+
+class RunHistoryStore:
+    # Appends each test run's outputs to a local SQLite database: row counts
+    # and last arrival dates of table checks, and the value, q1 and q2 of
+    # every series an anomaly test evaluated. report() summarizes them per
+    # week or month without querying BigQuery again. Recording is opt-in:
+    # the database is at ANOMA_HISTORY_PATH, and nothing is recorded while
+    # it's unset. Recording failures are printed and never fail the test.
+    def __init__(self, path=None):
+        self.path = path if path is not None else os.environ.get("ANOMA_HISTORY_PATH", "")
+        self.enabled = self.path != ""
+        self._schema_ready = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if not self._schema_ready and os.path.dirname(self.path) != "":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        connection = sqlite3.connect(self.path, timeout=30)
+
+        with self._lock:
+            if not self._schema_ready:
+                # WAL lets the report read while tests are writing
+                connection.execute("pragma journal_mode=wal")
+                connection.executescript(SCHEMA)
+                self._schema_ready = True
+
+        return connection
+
+    def _replace_day(self, test_id, run_date, inserts):
+        # inserts: (table, insert query, rows), written in one transaction
+        connection = self._connect()
+
+        try:
+            with connection:
+                for table, insert_query, rows in inserts:
+                    connection.execute(f"delete from {table} where test_id = ? and run_date = ?", (test_id, run_date))
+                    connection.executemany(insert_query, rows)
+        finally:
+            connection.close()
+
+    def record_table_checks(self, test_id, test_type, table_checks, run_at=None):
+        # table_checks: (table_name, no_of_rows, last_entry_date, error) tuples
+        if not self.enabled:
+            return
+
+        run_at = run_at if run_at is not None else datetime.now()
+        run_date, week, month = _run_periods(run_at)
+
+        try:
+            self._replace_day(str(test_id), run_date, [(
+                "table_checks", 
+                "insert into table_checks values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
+                [
+                    (
+                        str(test_id), run_date, week, month, table_name, test_type, run_at.isoformat(), 
+                        None if no_of_rows is None else int(no_of_rows), 
+                        None if last_entry_date is None else str(last_entry_date), 
+                        error
+                    ) for table_name, no_of_rows, last_entry_date, error in table_checks
+                ]
+            )])
+        except Exception as e:
+            print(f"Couldn't record run history of test {test_id}: {e}")
+
+    def record_anomaly_series(self, test_id, series_df, threshold, run_at=None):
+        # series_df: a detection result, with an 'anomaly' column when it holds
+        # every evaluated series (detect_anomalies(all_series=True)); without
+        # one all its rows are anomalies and the number of series evaluated
+        # isn't known, so the run's rollup stores NULL series
+        if not self.enabled:
+            return
+
+        run_at = run_at if run_at is not None else datetime.now()
+        run_date, week, month = _run_periods(run_at)
+
+        if series_df.shape[0] == 0:
+            series_df = pd.DataFrame(columns=['dataset|table', "today's rows", "10%", "90%"])
+
+        all_series = 'anomaly' in series_df.columns
+        anomaly = series_df['anomaly'] if all_series else pd.Series(True, index=series_df.index)
+        values = series_df["today's rows"].astype(float)
+
+        try:
+            self._replace_day(str(test_id), run_date, [
+                (
+                    "anomaly_series", 
+                    "insert into anomaly_series values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", 
+                    zip(
+                        [str(test_id)] * series_df.shape[0], 
+                        [run_date] * series_df.shape[0], 
+                        [week] * series_df.shape[0], 
+                        [month] * series_df.shape[0], 
+                        series_df['dataset|table'].astype(str).tolist(), 
+                        [run_at.isoformat()] * series_df.shape[0], 
+                        values.tolist(), 
+                        series_df["10%"].astype(float).tolist(), 
+                        series_df["90%"].astype(float).tolist(), 
+                        [threshold] * series_df.shape[0], 
+                        anomaly.astype(int).tolist()
+                    )
+                ), 
+                (
+                    "anomaly_runs", 
+                    "insert into anomaly_runs values (?, ?, ?, ?, ?, ?, ?, ?, ?)", 
+                    [(
+                        str(test_id), run_date, week, month, run_at.isoformat(), threshold, 
+                        int(series_df.shape[0]) if all_series else None, int(anomaly.sum()), float(values.sum())
+                    )]
+                )
+            ])
+        except Exception as e:
+            print(f"Couldn't record run history of test {test_id}: {e}")
+
+    def report(self, period="weekly", periods=8, test_ids=None, today=None):
+        # Summaries of the last `periods` weeks (from Monday) or months, the
+        # current one included, per test and table for table checks and per
+        # test for anomaly tests ('series' is the most series a run evaluated).
+        # series, evaluated and anomaly_rate are NULL for periods with runs
+        # that only recorded their anomalies. Returns (tables_df, anomalies_df).
+        today = today if today is not None else datetime.now().date()
+
+        if period == "weekly":
+            since = today - timedelta(days=today.weekday()) - timedelta(weeks=periods - 1)
+        elif period == "monthly":
+            since = pd.Timestamp(today).to_period("M").start_time.date()
+            since = (pd.Timestamp(since) - pd.DateOffset(months=periods - 1)).date()
+        else:
+            raise ValueError(f"Unknown report period {period}, expected one of {', '.join(PERIOD_COLUMNS)}")
+
+        period_column = PERIOD_COLUMNS[period]
+        filters = "run_date >= ?"
+        params = [since.isoformat()]
+
+        if test_ids is not None:
+            filters += f" and test_id in ({', '.join('?' * len(test_ids))})"
+            params += [str(test_id) for test_id in test_ids]
+
+        tables_query = f"""
+            select
+                test_id, test_type, table_name, {period_column} period_start, 
+                count(*) runs, 
+                sum(error is not null) failed_runs, 
+                min(no_of_rows) min_rows, 
+                avg(no_of_rows) avg_rows, 
+                max(no_of_rows) max_rows, 
+                sum(no_of_rows = 0) zero_row_runs, 
+                sum(test_type = 'data_arrived_or_not' and error is null and
+                    (last_entry_date is null or last_entry_date < run_date)) late_runs, 
+                max(last_entry_date) last_entry_date
+            from table_checks
+            where {filters}
+            group by test_id, test_type, table_name, period_start
+            order by test_id, table_name, period_start
+        """
+
+        anomalies_query = f"""
+            with runs as (
+                select
+                    test_id, {period_column} period_start, 
+                    count(*) runs, 
+                    case when count(series) = count(*) then max(series) end series, 
+                    case when count(series) = count(*) then sum(series) end evaluated, 
+                    sum(anomalies) anomalies, 
+                    avg(total_value) avg_daily_total
+                from anomaly_runs
+                where {filters}
+                group by test_id, period_start
+            ), 
+            anomalous as (
+                select test_id, {period_column} period_start, count(distinct series) anomalous_series
+                from anomaly_series indexed by anomaly_series_anomalies
+                where {filters} and anomaly = 1
+                group by test_id, period_start
+            )
+            select
+                runs.test_id, runs.period_start, runs, series, evaluated, anomalies, 
+                case when evaluated is not null then 1.0 * anomalies / max(evaluated, 1) end anomaly_rate, 
+                coalesce(anomalous_series, 0) anomalous_series, 
+                avg_daily_total
+            from runs
+            left join anomalous using (test_id, period_start)
+            order by runs.test_id, runs.period_start
+        """
+
+        connection = self._connect()
+
+        try:
+            return (
+                pd.read_sql_query(tables_query, connection, params=params), 
+                pd.read_sql_query(anomalies_query, connection, params=params * 2)
+            )
+        finally:
+            connection.close()
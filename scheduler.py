@@ -1,59 +1,105 @@
+import hashlib
 import traceback
+import threading
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import scheduler_v1
 from googleapiclient import discovery
+from googleapiclient.errors import HttpError
 from utils import Utils
-import json
+from config_store import get_config_store
+from metrics import RunMetrics
+import metrics
 
 
 class Scheduler:
-    def __init__(self, read_from_config_json=False):
+    def __init__(self, read_from_config_json=False, batch_mode=False, utils=None, scheduler_service=None):
+        # utils and scheduler_service can be passed in to run against stand-ins
+        # (see fakes.py) instead of the Google APIs
         self.read_from_config_json = read_from_config_json
-        self.utils = Utils()
+        self.batch_mode = batch_mode
+        self.utils = utils if utils is not None else Utils()
         self.credentials = self.utils.get_scheduler_credentials_with_scopes(read_from_local_service_account=True)
         self.location = "us-central1"
         self.project_id = "marketlytics-dataware-house"
         self.cloud_function_url = "https://us-central1-marketlytics-dataware-house.cloudfunctions.net/generalized-anomaly-bot/get_anomalies?test_id="
+        # run_tests entry point deployed as its own function, used in batch mode
+        self.batch_function_url = "https://us-central1-marketlytics-dataware-house.cloudfunctions.net/generalized-anomaly-bot-batch/run_tests?"
         self.parent = f"projects/{self.project_id}/locations/{self.location}"
-        self.scheduler_service = discovery.build(
-            'cloudscheduler', 
-            'v1', 
-            credentials=self.credentials
-        )
+        self.max_workers = 8
+        self.num_retries = 3
+        self._thread_local = threading.local()
+        self.shared_scheduler_service = scheduler_service
 
-        self.cloud_scheduler_client = scheduler_v1.CloudSchedulerClient(
-            credentials=self.credentials
-        )
+        if scheduler_service is not None:
+            self.scheduler_service = scheduler_service
+            self.cloud_scheduler_client = None
+        else:
+            self.scheduler_service = discovery.build(
+                'cloudscheduler', 
+                'v1', 
+                credentials=self.credentials
+            )
 
-        self.sheets_df = self.utils.get_sheet_as_df(
+            self.cloud_scheduler_client = scheduler_v1.CloudSchedulerClient(
+                credentials=self.credentials
+            )
+
+        # The scheduler syncs jobs from the latest config, so skip the TTL
+        self.tests = get_config_store(read_from_config_json).get_all_tests(
+            self.utils, 
             self.credentials, 
-            'queries'
+            force_refresh=True
         )
 
-        config_file = open("config.json", "r")
-
-        self.config = json.load(config_file)
-
-        config_file.close()
-
     def _get_job_params(self, test_id):
-        sheets_sliced_df = self.sheets_df[self.sheets_df['test_id'] == str(test_id)]
+        test_rows = self.tests.get(str(test_id), ())
 
-        if sheets_sliced_df.shape[0] > 0:
+        if len(test_rows) > 0:
             return {
-                'project_id': sheets_sliced_df['project_name'].iloc[0], 
-                'name': sheets_sliced_df['test_name'].iloc[0], 
+                'project_id': test_rows[0].project_name, 
+                'name': test_rows[0].test_name, 
                 'target': {"uri": self.cloud_function_url + str(test_id)}, 
-                'schedule': sheets_sliced_df['cron_schedule'].iloc[0], 
-                'timezone': sheets_sliced_df['timezone'].iloc[0]
+                'schedule': test_rows[0].cron_schedule, 
+                'timezone': test_rows[0].timezone
             }
         
         return None
 
+    def _get_batch_jobs_params(self):
+        # One job per (cron_schedule, timezone) slot, calling run_tests for all
+        # the tests that share that slot
+        slots = sorted({(test_rows[0].cron_schedule, test_rows[0].timezone) for test_rows in self.tests.values()}, key=str)
+        jobs_params = []
+
+        for schedule, timezone in slots:
+            slot_id = hashlib.sha1(f"{schedule}|{timezone}".encode()).hexdigest()[:12]
+
+            # urlencode would send a missing timezone as the string 'None'
+            slot_params = {'schedule': schedule} if timezone is None else {'schedule': schedule, 'timezone': timezone}
+
+            jobs_params.append({
+                'project_id': self.project_id, 
+                'name': f"anoma-bot-batch-{slot_id}", 
+                'target': {"uri": self.batch_function_url + urlencode(slot_params)}, 
+                'schedule': schedule, 
+                'timezone': timezone
+            })
+
+        return jobs_params
+
+    def _get_desired_jobs_params(self):
+        if self.batch_mode:
+            return self._get_batch_jobs_params()
+
+        return [self._get_job_params(test_id) for test_id in self.tests]
+
     def _does_job_need_to_be_updated(self, orig_job, new_job_params):
         job_name = self.parent + "/jobs/" + new_job_params["name"]
 
         if (orig_job["name"] == job_name) and (orig_job["schedule"] == new_job_params["schedule"]) and \
-            (orig_job["timeZone"] == new_job_params["timezone"]):
+            (orig_job["timeZone"] == new_job_params["timezone"]) and \
+            (orig_job.get("httpTarget", {}).get("uri") == new_job_params["target"]["uri"]):
             return False
         
         return True
@@ -63,8 +109,10 @@ class Scheduler:
             return self.scheduler_service.projects().locations().jobs().get(
                 name=self.parent + "/jobs/" + job_name
             ).execute()
-        except:
-            return False
+        except HttpError as e:
+            if e.resp.status == 404:
+                return False
+            raise
 
     def create_job(self, job_params, parent, job_name):
         job = {
@@ -102,39 +150,139 @@ class Scheduler:
             return self.update_job(job_params, job_name)
 
     def check_jobs(self):
-        if not self.read_from_config_json:
-            for i in range(self.sheets_df.shape[0]):
-                test_id = self.sheets_df['test_id'].iloc[i]
-                job_params = self._get_job_params(test_id)
-
-                print(f"Working for test id {test_id}")
-
-                if job_params is not None:
-                    job = self.does_job_exist(job_params["name"])
-                    if not job:
-                        self.manage_job_creation(False, job_params)
-                    elif self._does_job_need_to_be_updated(job, job_params):
-                        self.manage_job_creation(True, job_params)
-                    else:
-                        print(f"Job {job_params['name']} already exists with same configuration")
-                else:
-                    print("...")
+        for job_params in self._get_desired_jobs_params():
+            print(f"Working for job {job_params['name']}")
+
+            job = self.does_job_exist(job_params["name"])
+
+            if not job:
+                self.manage_job_creation(False, job_params)
+            elif self._does_job_need_to_be_updated(job, job_params):
+                self.manage_job_creation(True, job_params)
+            else:
+                print(f"Job {job_params['name']} already exists with same configuration")
+
+    def _get_thread_scheduler_service(self):
+        # Discovery clients share one httplib2 connection and aren't thread
+        # safe, so each worker thread builds its own
+        if self.shared_scheduler_service is not None:
+            return self.shared_scheduler_service
+
+        if not hasattr(self._thread_local, 'scheduler_service'):
+            self._thread_local.scheduler_service = discovery.build(
+                'cloudscheduler', 
+                'v1', 
+                credentials=self.credentials, 
+                cache_discovery=False
+            )
+
+        return self._thread_local.scheduler_service
+
+    def list_jobs(self):
+        jobs = {}
+        jobs_api = self.scheduler_service.projects().locations().jobs()
+        request = jobs_api.list(parent=self.parent, pageSize=500)
+
+        while request is not None:
+            response = request.execute(num_retries=self.num_retries)
+
+            for job in response.get("jobs", []):
+                jobs[job["name"]] = job
+
+            request = jobs_api.list_next(request, response)
+
+        return jobs
+
+    def plan_jobs(self, delete_orphans=True):
+        # Diffs the configured tests against the jobs that already exist under
+        # self.parent. Only jobs targeting this function are considered
+        # orphans, so unrelated jobs in the same location are never deleted.
+        existing_jobs = self.list_jobs()
+        desired_jobs = {}
+
+        for job_params in self._get_desired_jobs_params():
+            desired_jobs[self.parent + "/jobs/" + job_params["name"]] = job_params
+
+        plan = []
+
+        for job_name, job_params in desired_jobs.items():
+            if job_name not in existing_jobs:
+                plan.append(("create", job_name, job_params))
+            elif self._does_job_need_to_be_updated(existing_jobs[job_name], job_params):
+                plan.append(("update", job_name, job_params))
+
+        if delete_orphans:
+            for job_name, job in existing_jobs.items():
+                uri = job.get("httpTarget", {}).get("uri", "")
+
+                # Switching between per-test and batch mode deletes the other mode's jobs
+                if job_name not in desired_jobs and \
+                        (uri.startswith(self.cloud_function_url) or uri.startswith(self.batch_function_url)):
+                    plan.append(("delete", job_name, None))
+
+        print(f"{len(existing_jobs)} existing jobs, {len(desired_jobs)} configured tests, {len(plan)} changes")
+
+        for action, job_name, job_params in plan:
+            print(f"  {action} {job_name}" + \
+                ("" if job_params is None else f" ({job_params['schedule']} {job_params['timezone']})"))
+
+        return plan
+
+    def _apply_change(self, change):
+        action, job_name, job_params = change
+        jobs_api = self._get_thread_scheduler_service().projects().locations().jobs()
+
+        if action == "create":
+            request = jobs_api.create(parent=self.parent, body={
+                'name': job_name, 
+                'http_target': job_params['target'], 
+                'schedule': job_params['schedule'], 
+                'time_zone': job_params['timezone']
+            })
+        elif action == "update":
+            request = jobs_api.patch(name=job_name, body={
+                'http_target': job_params['target'], 
+                'schedule': job_params['schedule'], 
+                'time_zone': job_params['timezone']
+            })
         else:
-            for con in self.config["tests"]:
-                test_id = con["test_id"]
-                job_params = {
-                    'project_id': con['project_name'], 
-                    'name': con['test_name'], 
-                    'target': {"uri": self.cloud_function_url + str(test_id)}, 
-                    'schedule': con['cron_schedule'], 
-                    'timezone': con['timezone']
-                }
-
-                job = self.does_job_exist(job_params["name"])
-                
-                if not job:
-                    self.manage_job_creation(False, job_params)
-                elif self._does_job_need_to_be_updated(job, job_params):
-                    self.manage_job_creation(True, job_params)
-                else:
-                    print(f"Job {job_params['name']} already exists with same configuration")
+            request = jobs_api.delete(name=job_name)
+
+        # execute retries 429s and 5xx with exponential backoff
+        return request.execute(num_retries=self.num_retries)
+
+    def reconcile(self, dry_run=False, delete_orphans=True):
+        # Bulk alternative to check_jobs: one paginated list call, an in-memory
+        # diff, then creates/updates/deletes applied concurrently
+        with RunMetrics('scheduler_reconcile', batch_mode=self.batch_mode, dry_run=dry_run) as run_metrics:
+            with metrics.span('plan'):
+                plan = self.plan_jobs(delete_orphans=delete_orphans)
+
+            for action, _, _ in plan:
+                metrics.add(action + 's')
+
+            if dry_run or len(plan) == 0:
+                return plan, []
+
+            with metrics.span('apply'):
+                failed = self._apply_plan(plan)
+
+            run_metrics.update(failed=len(failed))
+
+            return plan, failed
+
+    def _apply_plan(self, plan):
+        def apply(change):
+            try:
+                self._apply_change(change)
+                return None
+            except Exception:
+                print(f"Failed to {change[0]} {change[1]}: {traceback.format_exc()}")
+                return change
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(plan))) as executor:
+            failed = [change for change in executor.map(apply, plan) if change is not None]
+
+        print(f"Applied {len(plan) - len(failed)} of {len(plan)} changes")
+
+        return failed
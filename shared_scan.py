@@ -0,0 +1,103 @@
+import os
+import threading
+import metrics
+
+
+# Execution modes whose tests read the plain anomaly query result; pushdown,
+# compact and incremental tests build their own queries or fetches, and
+# streaming tests aggregate their result batch by batch instead of fetching
+# it whole
+SHARED_EXECUTION_MODES = (None,)
+
+
+class SharedAnomalyScan:
+    # A single query for several anomaly tests reading the same table. The
+    # first test to ask for its pivot runs the query (recording it in its own
+    # run metrics); the others wait for that result and count a
+    # shared_scan_hits instead. The result is released once every test of
+    # the scan has taken its pivot (and fetched again if one asks later).
+    # The tests skip their own bytes budget check, so the shared query's
+    # estimate is logged once before it runs.
+    def __init__(self, tests):
+        self.tests = tests
+        self.project_id = tests[0].project_name
+        self._pending = len(tests)
+        self._result = None
+        self._error = None
+        self._columns = None
+        self._lock = threading.Lock()
+
+    def _fetch(self, utils, credentials):
+        query, self._columns = utils.construct_shared_anomaly_query(self.tests)
+
+        print(f"Shared scan of {self.tests[0].main_table_name} for tests {', '.join(self._columns)}")
+
+        utils.check_bytes_budget(
+            credentials=credentials, 
+            query_script=query, 
+            project_id=self.project_id
+        )
+
+        self._result = utils.get_query_results_as_df(
+            credentials=credentials, 
+            query_script=query, 
+            project_id=self.project_id
+        )
+
+    def get_pivot(self, utils, credentials, test_id):
+        with self._lock:
+            if self._result is None and self._error is None:
+                try:
+                    self._fetch(utils, credentials)
+                except Exception as e:
+                    self._error = e
+            else:
+                metrics.add('shared_scan_hits')
+
+            result = self._result
+            self._pending -= 1
+
+            if self._pending <= 0:
+                self._result = None
+
+        if self._error is not None:
+            raise RuntimeError(f"Shared scan of {self.tests[0].main_table_name} failed: {self._error}")
+
+        return utils.shared_result_to_pivot(result, *self._columns[str(test_id)])
+
+
+def plan_shared_scans(tests, test_ids):
+    # Groups the anomaly tests among test_ids by project, main_table_name and
+    # date_column_name, and returns test_id -> SharedAnomalyScan for every
+    # group of more than one test. Tests with a bytes budget keep their own
+    # query, so their budget still applies to exactly what they read. Set
+    # ANOMA_SHARED_SCANS=false to run every test's own query.
+    if os.environ.get("ANOMA_SHARED_SCANS", "true").lower() != "true":
+        return {}
+
+    groups = {}
+
+    for test_id in dict.fromkeys(str(test_id) for test_id in test_ids):
+        test_rows = tests.get(test_id, ())
+
+        if len(test_rows) < 1:
+            continue
+
+        test = test_rows[0]
+
+        if test.test_type != 'anomaly' or test.execution_mode not in SHARED_EXECUTION_MODES or \
+                test.max_bytes_processed is not None:
+            continue
+
+        groups.setdefault((test.project_name, test.main_table_name, test.date_column_name), []).append(test)
+
+    scans = {}
+
+    for group in groups.values():
+        if len(group) > 1:
+            scan = SharedAnomalyScan(group)
+
+            for test in group:
+                scans[str(test.test_id)] = scan
+
+    return scans
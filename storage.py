@@ -0,0 +1,61 @@
+import contextlib
+import os
+import tempfile
+
+
+# Whole-object reads and writes at either a local path or a gs://bucket/name
+# location, for the alert cache, anomaly states and the config snapshot.
+# utils and credentials are only needed for gs:// paths. Local writes go to
+# a uniquely named temp file next to the target and are moved into place
+# with os.replace, so concurrent writers never share a temp file and readers
+# never see a partial one.
+
+
+def _blob(path, utils, credentials):
+    from google.cloud.storage.blob import Blob
+
+    return Blob.from_string(path, client=utils.get_storage_client(credentials))
+
+
+def read_bytes(path, utils=None, credentials=None):
+    # Returns None when nothing is stored at path
+    if path.startswith("gs://"):
+        blob = _blob(path, utils, credentials)
+
+        if not blob.exists():
+            return None
+
+        return blob.download_as_bytes()
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as stored_file:
+        return stored_file.read()
+
+
+def write_bytes(path, data, utils=None, credentials=None, content_type="application/octet-stream"):
+    if path.startswith("gs://"):
+        _blob(path, utils, credentials).upload_from_string(data, content_type=content_type)
+        return
+
+    directory = os.path.dirname(path)
+
+    if directory != "":
+        os.makedirs(directory, exist_ok=True)
+
+    temp_file = tempfile.NamedTemporaryFile(
+        dir=directory or ".", 
+        prefix=os.path.basename(path) + ".", 
+        suffix=".tmp", 
+        delete=False
+    )
+
+    try:
+        with temp_file:
+            temp_file.write(data)
+        os.replace(temp_file.name, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_file.name)
+        raise
@@ -0,0 +1,90 @@
+import pandas as pd
+import pytest
+from anomaly_state import AnomalyStateStore, merge_state_pivot
+from fakes import FakeUtils, SyntheticWarehouse
+
+
+# The execution modes must find the same anomalies as the default mode; these
+# run them against the same synthetic table in fakes.py and compare every
+# evaluated series, not just the anomalous ones.
+TABLE_NAME = "fake-project.fake_dataset.anomaly_1"
+WINDOW_DAYS = 90
+
+
+@pytest.fixture
+def utils():
+    return FakeUtils(SyntheticWarehouse(series=300, days=400))
+
+
+def build_query(utils, lookback_days=None, start_date=None):
+    return utils.construct_query_for_test(
+        main_table_name=TABLE_NAME, 
+        date_column_name="date", 
+        dataset_column_name="dataset_id", 
+        dataset_table_column_name="table_name", 
+        entries_column_name="entries", 
+        test_type="anomaly", 
+        lookback_days=lookback_days, 
+        start_date=start_date
+    )
+
+
+def fetch_pivot(utils, query):
+    return utils.get_anomaly_pivot(utils.credentials, query, "fake-project")
+
+
+@pytest.mark.parametrize("threshold", [5, 10, 25])
+def test_compact_matches_default(utils, threshold):
+    query = build_query(utils)
+
+    default_df = utils.detect_anomalies(fetch_pivot(utils, query), threshold, all_series=True)
+    compact_df = utils.detect_anomalies_compact(
+        utils.get_compact_result(utils.credentials, query, "fake-project"), 
+        threshold, 
+        all_series=True
+    )
+
+    assert default_df['anomaly'].any()
+    pd.testing.assert_frame_equal(default_df, compact_df, check_exact=True)
+
+
+@pytest.mark.parametrize("days_since_state", [1, 3])
+def test_incremental_matches_full(utils, tmp_path, days_since_state):
+    threshold = 10
+    full_pivot = fetch_pivot(utils, build_query(utils, lookback_days=WINDOW_DAYS))
+
+    # The state a run days_since_state days ago would have saved, round
+    # tripped through the store
+    store = AnomalyStateStore(str(tmp_path))
+    earlier_pivot = fetch_pivot(utils, build_query(utils)).iloc[:-days_since_state]
+    store.save(utils, utils.credentials, "1", merge_state_pivot(None, earlier_pivot, WINDOW_DAYS))
+    state_pivot = store.load(utils, utils.credentials, "1")
+
+    new_pivot = fetch_pivot(utils, build_query(utils, start_date=state_pivot.index[-1].strftime("%Y-%m-%d")))
+    merged_pivot = merge_state_pivot(state_pivot, new_pivot, WINDOW_DAYS)
+
+    full_df = utils.detect_anomalies(full_pivot, threshold, all_series=True)
+    incremental_df = utils.detect_anomalies(merged_pivot, threshold, all_series=True)
+
+    assert full_df['anomaly'].any()
+    pd.testing.assert_frame_equal(full_df, incremental_df, check_exact=True)
+
+
+def test_empty_state_is_rebuilt(utils, tmp_path):
+    store = AnomalyStateStore(str(tmp_path))
+    pivot_df = fetch_pivot(utils, build_query(utils, lookback_days=WINDOW_DAYS))
+
+    # A state saved without any day has no last day to resume from
+    store.save(utils, utils.credentials, "1", pivot_df.iloc[:0])
+    assert store.load(utils, utils.credentials, "1") is None
+
+    # Without a state the whole window is fetched and kept
+    merged_pivot = merge_state_pivot(None, pivot_df, WINDOW_DAYS)
+    pd.testing.assert_frame_equal(
+        utils.detect_anomalies(pivot_df, 10, all_series=True), 
+        utils.detect_anomalies(merged_pivot, 10, all_series=True), 
+        check_exact=True
+    )
+
+    # A run that fetched no new day keeps the saved state as it was
+    pd.testing.assert_frame_equal(merge_state_pivot(merged_pivot, pivot_df.iloc[:0], WINDOW_DAYS), merged_pivot)
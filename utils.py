@@ -1,12 +1,77 @@
-from google.oauth2 import service_account
-from google.cloud import bigquery
-from google.cloud import storage
-from google.cloud.storage.blob import Blob
-from apiclient.discovery import build
+# The Google client libraries are imported inside the methods that use them,
+# so a cold start only pays for the ones its code path needs
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+import threading
+import traceback
 import json
 import pandas as pd
 import numpy as np
 import os
+import metrics
+from window_percentiles import sorted_nan_percentiles, window_nan_percentiles
+
+
+class ClientCache:
+    # Process-level cache for credentials and API clients. Cloud Functions keep
+    # module state alive between invocations on a warm instance, so anything
+    # stored here is reused by every later trigger handled by the same instance.
+    def __init__(self, refresh_margin=timedelta(minutes=5)):
+        self.refresh_margin = refresh_margin
+        self._entries = {}
+        self._lock = threading.RLock()
+        self.hits = {}
+        self.misses = {}
+        self.refreshes = 0
+
+    def get(self, kind, key, factory):
+        with self._lock:
+            if (kind, key) in self._entries:
+                self.hits[kind] = self.hits.get(kind, 0) + 1
+                metrics.add('client_cache_hits')
+                return self._entries[(kind, key)]
+
+            self.misses[kind] = self.misses.get(kind, 0) + 1
+            metrics.add('client_cache_misses')
+            value = factory()
+            self._entries[(kind, key)] = value
+
+            return value
+
+    def refresh_if_expiring(self, credentials):
+        # Tokens that have never been fetched are left to the client libraries,
+        # which fetch them lazily on first use.
+        if getattr(credentials, 'token', None) is None or getattr(credentials, 'expiry', None) is None:
+            return credentials
+
+        # google-auth keeps expiry as a naive UTC datetime
+        if credentials.expiry - datetime.utcnow() < self.refresh_margin:
+            from google.auth.transport.requests import Request
+
+            with self._lock:
+                credentials.refresh(Request())
+                self.refreshes += 1
+
+        return credentials
+
+    def invalidate(self, kind=None):
+        with self._lock:
+            if kind is None:
+                self._entries.clear()
+            else:
+                for entry_key in [entry_key for entry_key in self._entries if entry_key[0] == kind]:
+                    del self._entries[entry_key]
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                kind: {'hits': self.hits.get(kind, 0), 'misses': self.misses.get(kind, 0)}
+                for kind in sorted(set(self.hits) | set(self.misses))
+            } | {'token_refreshes': self.refreshes}
+
+
+client_cache = ClientCache()
 
 
 class Utils:
@@ -14,6 +79,7 @@ class Utils:
         self.credentials_scopes = [
             "https://www.googleapis.com/auth/bigquery", 
             "https://www.googleapis.com/auth/spreadsheets.readonly", 
+            "https://www.googleapis.com/auth/drive.metadata.readonly", 
             "https://www.googleapis.com/auth/cloud-platform"
         ]
 
@@ -22,8 +88,24 @@ class Utils:
         self.anomaly_tests_scheduler_service_acc_path = os.environ.get("ANOMALY_TESTS_SCHEDULER_SERVICE_ACC_PATH", None)
         # self.storage_client = storage.Client()
         self.storage_client = None
+        self.max_query_workers = int(os.environ.get("ANOMA_MAX_QUERY_WORKERS", 8))
+        self.use_bq_storage_api = os.environ.get("ANOMA_USE_BQ_STORAGE_API", "false").lower() == "true"
+        # Series per dense block in the compact execution mode
+        self.compact_block_series = int(os.environ.get("ANOMA_COMPACT_BLOCK_SERIES", 2048))
 
     def get_credentials_with_scopes(self, read_from_local_service_account=False):
+        credentials = client_cache.get(
+            'credentials', 
+            (self.anomaly_tests_runner_service_acc_path, tuple(self.credentials_scopes)), 
+            self._load_runner_credentials
+        )
+
+        return client_cache.refresh_if_expiring(credentials)
+
+    def _load_runner_credentials(self):
+        from google.oauth2 import service_account
+        from google.cloud.storage.blob import Blob
+
         blob = Blob.from_string(self.anomaly_tests_runner_service_acc_path)
         file = blob.download_as_string(self.storage_client)
         return service_account.Credentials.from_service_account_info(
@@ -32,6 +114,18 @@ class Utils:
         )
 
     def get_scheduler_credentials_with_scopes(self, read_from_local_service_account=False):
+        credentials = client_cache.get(
+            'scheduler_credentials', 
+            (self.anomaly_tests_scheduler_service_acc_path, read_from_local_service_account, tuple(self.credentials_scopes)), 
+            lambda: self._load_scheduler_credentials(read_from_local_service_account)
+        )
+
+        return client_cache.refresh_if_expiring(credentials)
+
+    def _load_scheduler_credentials(self, read_from_local_service_account):
+        from google.oauth2 import service_account
+        from google.cloud.storage.blob import Blob
+
         if not read_from_local_service_account:
             blob = Blob.from_string(self.anomaly_tests_scheduler_service_acc_path)
             file = blob.download_as_string(self.storage_client)
@@ -46,7 +140,17 @@ class Utils:
             )
 
     def construct_query_for_test(self, main_table_name=None, date_column_name=None, dataset_column_name=None, 
-                                    dataset_table_column_name=None, entries_column_name=None, test_type=None):
+                                    dataset_table_column_name=None, entries_column_name=None, test_type=None, 
+                                    lookback_days=None, start_date=None):
+        # Restricting the anomaly history to a trailing window lets BigQuery
+        # prune partitions instead of reading the table's full history
+        lookback_filter = "" if lookback_days is None else \
+            f"where {date_column_name} >= date_sub(current_date(), interval {int(lookback_days)} day)"
+
+        # Incremental runs only fetch the days from start_date onwards
+        if start_date is not None:
+            lookback_filter = f"where {date_column_name} >= date '{start_date}'"
+
         if test_type == 'data_arrived_or_not':
             query = f"""
                 select max({date_column_name}) last_entry_date from 
@@ -62,6 +166,7 @@ class Utils:
             query = f"""
                 with orig_table as (
                     select * from {main_table_name} 
+                    {lookback_filter}
                 )
 
                 select {date_column_name}, concat({dataset_column_name}, '|', {dataset_table_column_name}) column_to_pivot_on, 
@@ -71,10 +176,227 @@ class Utils:
              query = f"""
                 select {date_column_name}, {dataset_table_column_name} column_to_pivot_on, 
                 {entries_column_name} current_day_rows from {main_table_name}
+                {lookback_filter}
             """
 
         return query
 
+    def construct_shared_anomaly_query(self, tests):
+        # One query answering several anomaly tests (rows with the same
+        # main_table_name and date_column_name): every test's series and
+        # entries expressions are selected side by side, over the widest
+        # lookback_days of the group, with a flag column for tests whose own
+        # window is narrower. Identical expressions are selected once. Returns
+        # the query and, per test_id, the (series, entries, window flag or
+        # None) result columns that shared_result_to_pivot takes.
+        main_table_name = tests[0].main_table_name
+        date_column_name = tests[0].date_column_name
+
+        lookbacks = [test.lookback_days for test in tests]
+        scan_lookback = None if any(lookback is None for lookback in lookbacks) else max(lookbacks)
+        lookback_filter = "" if scan_lookback is None else \
+            f"where {date_column_name} >= date_sub(current_date(), interval {int(scan_lookback)} day)"
+
+        aliases = {}
+
+        def alias(expression, prefix):
+            if expression not in aliases:
+                aliases[expression] = f"{prefix}_{sum(name.startswith(prefix) for name in aliases.values())}"
+
+            return aliases[expression]
+
+        columns = {}
+
+        for test in tests:
+            if test.dataset_column_name is not None:
+                series = f"concat({test.dataset_column_name}, '|', {test.dataset_table_column_name})"
+            else:
+                series = f"{test.dataset_table_column_name}"
+
+            window = None if test.lookback_days is None or test.lookback_days == scan_lookback else alias(
+                f"{date_column_name} >= date_sub(current_date(), interval {int(test.lookback_days)} day)", 'in_window'
+            )
+
+            columns[str(test.test_id)] = (alias(series, 'series'), alias(f"{test.entries_column_name}", 'entries'), window)
+
+        select_list = ", \n                ".join(f"{expression} {name}" for expression, name in aliases.items())
+
+        query = f"""
+            select {date_column_name} date, 
+                {select_list}
+            from {main_table_name}
+            {lookback_filter}
+        """
+
+        return query, columns
+
+    def shared_result_to_pivot(self, query_result_df, series_column, entries_column, window_column=None):
+        # One test's pivot from a construct_shared_anomaly_query result, the
+        # same as get_anomaly_pivot on the test's own query
+        if window_column is not None:
+            query_result_df = query_result_df[query_result_df[window_column].fillna(False).astype(bool).to_numpy()]
+
+        with metrics.span('pivot'):
+            return pd.DataFrame({
+                'date': query_result_df['date'].to_numpy(), 
+                'column_to_pivot_on': query_result_df[series_column].to_numpy(), 
+                'current_day_rows': query_result_df[entries_column].to_numpy()
+            }).pivot_table(
+                index='date', 
+                columns = 'column_to_pivot_on',
+                values = 'current_day_rows'
+            )
+
+    def construct_pushdown_anomaly_query(self, anomaly_query, date_column_name, threshold):
+        # Runs the same fence rule as detect_anomalies inside BigQuery: the last
+        # date across all series is compared with PERCENTILE_CONT (linear, like
+        # np.percentile) over each series' earlier values, and only anomalous
+        # series are returned. Duplicate (date, series) rows are averaged, as
+        # pivot_table does. q1/q2 can differ from the Python path by floating
+        # point rounding only (relative difference below 1e-9), so results only
+        # differ for values sitting within that distance of a fence.
+        lower = threshold / 100
+        upper = (100 - threshold) / 100
+
+        query = f"""
+            with base as (
+                {anomaly_query}
+            ), 
+
+            series as (
+                select {date_column_name} date, column_to_pivot_on, avg(current_day_rows) current_day_rows 
+                from base 
+                where {date_column_name} is not null and column_to_pivot_on is not null and current_day_rows is not null 
+                group by 1, 2
+            ), 
+
+            last_day as (
+                select max(date) last_date from series
+            ), 
+
+            quartiles as (
+                select distinct 
+                    column_to_pivot_on, 
+                    percentile_cont(current_day_rows, {lower!r}) over (partition by column_to_pivot_on) q1, 
+                    percentile_cont(current_day_rows, {upper!r}) over (partition by column_to_pivot_on) q2, 
+                    count(1) over (partition by column_to_pivot_on) history_days 
+                from series cross join last_day 
+                where date < last_date
+            )
+
+            select 
+                series.column_to_pivot_on, 
+                series.current_day_rows, 
+                quartiles.q1, 
+                quartiles.q2 
+            from series 
+            cross join last_day 
+            join quartiles using (column_to_pivot_on) 
+            where series.date = last_day.last_date 
+                and quartiles.history_days >= 3 
+                and (series.current_day_rows < quartiles.q1 - 1.5 * (quartiles.q2 - quartiles.q1) 
+                    or series.current_day_rows > quartiles.q2 + 1.5 * (quartiles.q2 - quartiles.q1)) 
+            order by series.column_to_pivot_on
+        """
+
+        return query
+
+    def pushdown_result_to_anomalies(self, query_result_df):
+        if query_result_df.shape[0] == 0:
+            print(f"No anomalies found")
+            return pd.DataFrame()
+
+        return pd.DataFrame({
+            'dataset|table': query_result_df['column_to_pivot_on'].to_numpy(), 
+            "today's rows": query_result_df['current_day_rows'].to_numpy(dtype=np.float64), 
+            "10%": query_result_df['q1'].to_numpy(dtype=np.float64), 
+            "90%": query_result_df['q2'].to_numpy(dtype=np.float64)
+        })
+
+    def construct_partition_metadata_query(self, main_table_name, date_column_name):
+        table_path = main_table_name.replace('`', '').split('.')
+        dataset_path = '.'.join(table_path[:-1])
+        table_name = table_path[-1]
+
+        # Daily and hourly partition ids both start with YYYYMMDD; monthly and
+        # yearly ones (YYYYMM, YYYY) can't answer for a single day and are
+        # counted as coarse_partitions. Rows still in the streaming buffer sit
+        # in __UNPARTITIONED__ until they are flushed.
+        query = f"""
+            with partitioning as (
+                select max(column_name) partitioning_column 
+                from `{dataset_path}.INFORMATION_SCHEMA.COLUMNS` 
+                where table_name = '{table_name}' and is_partitioning_column = 'YES'
+            ), 
+
+            partitions as (
+                select 
+                    max(if(total_rows > 0 and regexp_contains(partition_id, r'^[0-9]{{8}}'), 
+                        parse_date('%Y%m%d', substr(partition_id, 1, 8)), null)) last_entry_date, 
+                    ifnull(sum(if(starts_with(partition_id, format_date('%Y%m%d', current_date())), total_rows, 0)), 0) no_of_rows, 
+                    ifnull(sum(if(partition_id = '__UNPARTITIONED__', total_rows, 0)), 0) unpartitioned_rows, 
+                    countif(regexp_contains(partition_id, r'^[0-9]{{1,7}}$')) coarse_partitions 
+                from `{dataset_path}.INFORMATION_SCHEMA.PARTITIONS` 
+                where table_name = '{table_name}'
+            )
+
+            select * from partitioning cross join partitions
+        """
+
+        return query
+
+    def run_table_check(self, credentials, project_id, main_table_name, date_column_name, test_type, 
+                            use_partition_metadata=False):
+        # Resolves data_arrived_or_not / no_of_rows for one table. With
+        # use_partition_metadata the answer is read from partition metadata
+        # (no table data scanned) whenever the table is partitioned on
+        # date_column_name; otherwise the regular query is run. Returns the
+        # result frame and the path that produced it ('partition_metadata' or 'query').
+        if use_partition_metadata:
+            try:
+                metadata_df = self.get_query_results_as_df(
+                    credentials=credentials, 
+                    query_script=self.construct_partition_metadata_query(main_table_name, date_column_name), 
+                    project_id=project_id
+                )
+
+                metadata = metadata_df.iloc[0]
+                partitioning_column = metadata['partitioning_column']
+
+                if pd.isna(partitioning_column) or str(partitioning_column).lower() != str(date_column_name).lower():
+                    print(f"{main_table_name} isn't partitioned on {date_column_name}, falling back to query")
+                elif metadata['coarse_partitions'] > 0:
+                    print(f"{main_table_name} isn't partitioned by day or hour, falling back to query")
+                elif metadata['unpartitioned_rows'] > 0:
+                    # Today's rows may still be in the streaming buffer
+                    print(f"{main_table_name} has rows in the streaming buffer, falling back to query")
+                elif test_type == 'data_arrived_or_not' and not pd.isna(metadata['last_entry_date']):
+                    print(f"Resolved {test_type} for {main_table_name} from partition metadata")
+                    return pd.DataFrame({'last_entry_date': [metadata['last_entry_date']]}), 'partition_metadata'
+                elif test_type == 'no_of_rows':
+                    print(f"Resolved {test_type} for {main_table_name} from partition metadata")
+                    return pd.DataFrame({'no_of_rows': [metadata['no_of_rows']]}), 'partition_metadata'
+                else:
+                    print(f"Partition metadata for {main_table_name} is incomplete, falling back to query")
+            except Exception as e:
+                print(f"Couldn't read partition metadata for {main_table_name}, falling back to query: {e}")
+
+        query = self.construct_query_for_test(
+            main_table_name=main_table_name, 
+            date_column_name=date_column_name, 
+            test_type=test_type
+        )
+
+        query_result_df = self.get_query_results_as_df(
+            credentials=credentials, 
+            query_script=query, 
+            project_id=project_id
+        )
+
+        print(f"Resolved {test_type} for {main_table_name} from query")
+
+        return query_result_df, 'query'
+
     def get_query_for_test(self, test_name):
         fp = open("queries/" + test_name + ".sql", "r")
         query = fp.read()
@@ -83,37 +405,235 @@ class Utils:
         return query
 
 
+    def get_sheets_service(self, credentials):
+        from googleapiclient.discovery import build
+
+        # Keyed by the credentials object itself: it stays referenced by the
+        # cached service, so its id can't be reused while the entry exists.
+        return client_cache.get(
+            'sheets', 
+            id(credentials), 
+            lambda: build('sheets', 'v4', credentials=credentials, cache_discovery=False)
+        )
+
+    def get_drive_service(self, credentials):
+        from googleapiclient.discovery import build
+
+        return client_cache.get(
+            'drive', 
+            id(credentials), 
+            lambda: build('drive', 'v3', credentials=credentials, cache_discovery=False)
+        )
+
+    def get_sheet_revision(self, credentials):
+        # Drive's file version increases on every edit of the sheet
+        with metrics.span('sheets_revision'):
+            return self.get_drive_service(credentials).files().get(
+                fileId=self.sheet_id, 
+                fields="version"
+            ).execute()["version"]
+
+    def get_bigquery_client(self, credentials, project_id):
+        from google.cloud import bigquery
+
+        return client_cache.get(
+            'bigquery', 
+            (id(credentials), project_id), 
+            lambda: bigquery.Client(credentials=credentials, project=project_id)
+        )
+
+    def get_storage_client(self, credentials):
+        from google.cloud import storage
+
+        return client_cache.get(
+            'storage', 
+            id(credentials), 
+            lambda: storage.Client(credentials=credentials, project=getattr(credentials, 'project_id', None))
+        )
+
     def get_sheet_as_df(self, credentials, range):
-        service = build('sheets', 'v4', credentials=credentials, cache_discovery=False)
+        service = self.get_sheets_service(credentials)
         sheets = service.spreadsheets()
 
-        sheet_values = sheets.values().get(
-            spreadsheetId=self.sheet_id, 
-            range=range
-        ).execute()["values"]
+        with metrics.span('sheets_read'):
+            sheet_values = sheets.values().get(
+                spreadsheetId=self.sheet_id, 
+                range=range
+            ).execute()["values"]
 
         return pd.DataFrame(
             sheet_values[1:], 
             columns=sheet_values[0]
         )
 
-    def get_query_results_as_df(self, credentials, query_script, project_id):
-        bq_client = bigquery.Client(
-            credentials=credentials, 
-            project=project_id
+    def estimate_query_bytes(self, credentials, query_script, project_id):
+        from google.cloud import bigquery
+
+        bq_client = self.get_bigquery_client(credentials, project_id)
+
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+
+        with metrics.span('bigquery_dry_run'):
+            return bq_client.query(query_script, job_config=job_config).total_bytes_processed
+
+    def check_bytes_budget(self, credentials, query_script, project_id, max_bytes_processed=None, 
+                            bytes_budget_action=None):
+        # Dry-runs the query and compares the estimate with the test's budget.
+        # Returns (estimated_bytes, allowed); over-budget queries are only
+        # refused when bytes_budget_action is 'refuse', otherwise a warning is logged.
+        try:
+            estimated_bytes = self.estimate_query_bytes(credentials, query_script, project_id)
+        except Exception as e:
+            print(f"Dry run failed, skipping bytes budget check: {e}")
+            return None, True
+
+        print(f"Estimated bytes processed: {estimated_bytes}" + \
+            ("" if max_bytes_processed is None else f" (budget {max_bytes_processed})"))
+
+        if max_bytes_processed is None or estimated_bytes <= max_bytes_processed:
+            return estimated_bytes, True
+
+        if bytes_budget_action == 'refuse':
+            print(f"Refusing query, estimate {estimated_bytes} exceeds budget {max_bytes_processed}")
+            return estimated_bytes, False
+
+        print(f"Warning: estimate {estimated_bytes} exceeds budget {max_bytes_processed}")
+        return estimated_bytes, True
+
+    def get_bqstorage_client(self, credentials):
+        # The Storage Read API streams results as Arrow record batches and is
+        # faster for large results, but needs google-cloud-bigquery-storage and
+        # the bigquery.readsessions permissions, so it's opt-in.
+        if not self.use_bq_storage_api:
+            return None
+
+        try:
+            from google.cloud import bigquery_storage
+        except ImportError:
+            print("google-cloud-bigquery-storage isn't installed, fetching results over REST")
+            return None
+
+        return client_cache.get(
+            'bqstorage', 
+            id(credentials), 
+            lambda: bigquery_storage.BigQueryReadClient(credentials=credentials)
         )
 
-        query_results = bq_client.query(query_script).result()
+    def run_query(self, credentials, query_script, project_id, maximum_bytes_billed=None):
+        from google.cloud import bigquery
 
-        rows = [dict(result) for result in query_results]
+        bq_client = self.get_bigquery_client(credentials, project_id)
 
-        query_result_df = pd.DataFrame(rows)    
+        # maximum_bytes_billed makes BigQuery itself fail the job if it would
+        # bill more than the budget
+        job_config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed)
+
+        with metrics.span('bigquery_job'):
+            query_job = bq_client.query(query_script, job_config=job_config)
+            query_results = query_job.result()
+
+        metrics.add('queries')
+        metrics.add('bytes_processed', query_job.total_bytes_processed or 0)
+        metrics.add('bytes_billed', query_job.total_bytes_billed or 0)
+        metrics.add('bigquery_cache_hits', int(bool(query_job.cache_hit)))
+
+        return query_results
+
+    def get_query_results_as_df(self, credentials, query_script, project_id, maximum_bytes_billed=None):
+        query_results = self.run_query(credentials, query_script, project_id, maximum_bytes_billed)
+
+        # Results are decoded column-wise through Arrow instead of building a
+        # Python dict per row. to_dataframe creates its own Storage API client
+        # unless told not to, so the opt-in applies here too.
+        with metrics.span('fetch'):
+            query_result_df = query_results.to_dataframe(
+                bqstorage_client=self.get_bqstorage_client(credentials), 
+                create_bqstorage_client=self.use_bq_storage_api, 
+                progress_bar_type=None
+            )
+
+        metrics.add('rows_fetched', query_result_df.shape[0])
 
         # if query_result_df.shape[0] > 0:
         #     query_result_df['dataset|table'] = query_result_df[['dataset_id', 'table_name']].agg('|'.join, axis=1)
 
         return query_result_df
 
+    def iter_query_result_frames(self, credentials, query_script, project_id, maximum_bytes_billed=None):
+        # Yields the results one Arrow record batch (as a DataFrame) at a time,
+        # so callers can aggregate without holding the whole result in memory
+        query_results = self.run_query(credentials, query_script, project_id, maximum_bytes_billed)
+
+        return query_results.to_dataframe_iterable(bqstorage_client=self.get_bqstorage_client(credentials))
+
+    def get_anomaly_pivot(self, credentials, query_script, project_id, maximum_bytes_billed=None, stream=False):
+        if stream:
+            # Result pages are fetched while the pivot is built, so in this
+            # mode the 'pivot' span includes the fetch
+            with metrics.span('pivot'):
+                return self.pivot_from_frames(
+                    self.iter_query_result_frames(credentials, query_script, project_id, maximum_bytes_billed)
+                )
+
+        query_result_df = self.get_query_results_as_df(credentials, query_script, project_id, maximum_bytes_billed)
+
+        if "column_to_pivot_on" in list(query_result_df.columns):
+            with metrics.span('pivot'):
+                return query_result_df.pivot_table(
+                    index='date', 
+                    columns = 'column_to_pivot_on',
+                    values = 'current_day_rows'
+                )
+
+        return query_result_df
+
+    def pivot_from_frames(self, frames):
+        # Streaming equivalent of pivot_table(index='date', columns='column_to_pivot_on',
+        # values='current_day_rows'): each batch is reduced to per (date, series)
+        # sums and counts, and only those partial aggregates are kept.
+        partials = []
+
+        for frame in frames:
+            metrics.add('rows_fetched', frame.shape[0])
+            values = frame['current_day_rows'].astype(np.float64)
+            partials.append(
+                values.groupby([frame['date'], frame['column_to_pivot_on']]).agg(['sum', 'count'])
+            )
+
+        if len(partials) == 0:
+            return pd.DataFrame()
+
+        totals = pd.concat(partials).groupby(level=[0, 1]).sum()
+        totals = totals[totals['count'] > 0]
+
+        pivot_df = (totals['sum'] / totals['count']).unstack('column_to_pivot_on')
+        pivot_df.index.name = 'date'
+
+        return pivot_df
+
+    def run_concurrently(self, functions):
+        # Calls each zero-argument function on a bounded thread pool and returns
+        # (result, error) per function, in the order given. A failing call
+        # doesn't stop the others; its error message is returned instead.
+        def run(function):
+            try:
+                return function(), None
+            except Exception as e:
+                print(f"{traceback.format_exc()}")
+                return None, str(e)
+
+        if len(functions) == 0:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self.max_query_workers, len(functions))) as executor:
+            return list(executor.map(run, [metrics.bind(function) for function in functions]))
+
+    def run_queries_concurrently(self, credentials, query_scripts, project_id):
+        return self.run_concurrently([
+            partial(self.get_query_results_as_df, credentials, query_script, project_id)
+            for query_script in query_scripts
+        ])
+
     def get_last_anomalous(self, column, threshold):
         if sum([str(x) != 'nan' for x in column[0:len(column) - 1]]) < 3:
             return None
@@ -121,7 +641,7 @@ class Utils:
         q1, q2 = np.percentile([x for x in column[0:len(column) - 1] if str(x) != 'nan'], [threshold, 100 - threshold])
         iqr = q2 - q1
 
-        last = column[-1]
+        last = column.iloc[-1]
 
         if str(last) != 'nan' and ((last < (q1 - (1.5 * iqr))) or (last > (q2 + (1.5 * iqr)))):
             return last, q1, q2
@@ -132,23 +652,274 @@ class Utils:
         nans_filtered_anomalies = anomalies.iloc[[str(x) != 'nan' and str(x) != 'None' for x in anomalies]]
 
         if len(nans_filtered_anomalies) > 0:
-            results_df = nans_filtered_anomalies.to_frame()
-            results_df = results_df.reset_index()
+            quartiles = list(zip(*nans_filtered_anomalies.tolist()))
+
+            return pd.DataFrame({
+                'dataset|table': list(nans_filtered_anomalies.index), 
+                "today's rows": list(quartiles[0]), 
+                "10%": list(quartiles[1]), 
+                "90%": list(quartiles[2])
+            })
+        else:
+            print(f"No anomalies found")
+            return pd.DataFrame()
+
+    def nan_percentiles(self, values, percentiles):
+        # Column-wise equivalent of np.percentile on the non-NaN values of each
+        # column (default 'linear' method), computed for all columns at once.
+        # Columns without any valid value come back as NaN.
+        valid_counts = np.count_nonzero(~np.isnan(values), axis=0)
+
+        return list(sorted_nan_percentiles(np.sort(values, axis=0), valid_counts, percentiles))
+
+    def detect_anomalies(self, pivot_df, threshold, all_series=False):
+        # Vectorised form of get_last_anomalous + check_anomaly: the last row of
+        # the pivot is compared against the IQR fences of all the rows before it,
+        # for every column in one pass. With all_series every series that has
+        # enough history is returned, with an 'anomaly' column marking the
+        # anomalous ones (see anomalous_series).
+        values = pivot_df.to_numpy(dtype=np.float64, na_value=np.nan)
+
+        if values.shape[0] < 2 or values.shape[1] == 0:
+            print(f"No anomalies found")
+            return pd.DataFrame()
+
+        if all_series:
+            columns, last, q1, q2, anomaly = self.fence_stats(values, threshold)
+        else:
+            columns, last, q1, q2 = self.find_anomalous_columns(values, threshold)
+
+        if len(columns) == 0:
+            print(f"No anomalies found")
+            return pd.DataFrame()
+
+        series_df = pd.DataFrame({
+            'dataset|table': pivot_df.columns[columns], 
+            "today's rows": last, 
+            "10%": q1, 
+            "90%": q2
+        })
+
+        if all_series:
+            series_df['anomaly'] = anomaly
+
+        return series_df
+
+    def anomalous_series(self, series_df):
+        # The anomalies of an all_series detection result, in the usual form
+        if 'anomaly' not in series_df.columns:
+            return series_df
+
+        return series_df[series_df['anomaly'].to_numpy()].drop(columns='anomaly').reset_index(drop=True)
 
-            quartiles_df = pd.DataFrame()
+    def fence_stats(self, values, threshold):
+        # The fence rule on a float64 dates x series array (at least 2 rows).
+        # Returns the positions of the columns with enough history and a last
+        # value, with their last value, q1, q2 and whether they're anomalous.
+        history = values[:-1]
+        last = values[-1]
 
-            for i, row in results_df.iterrows():
-                quartiles_df = quartiles_df.append(pd.DataFrame({
-                    'dataset|table': [row['column_to_pivot_on']], 
-                    "today's rows": [row[0][0]], 
-                    "10%": [row[0][1]], 
-                    "90%": [row[0][2]]
-                }))
+        enough_history = np.count_nonzero(~np.isnan(history), axis=0) >= 3
+        candidates = np.flatnonzero(enough_history & ~np.isnan(last))
 
-            quartiles_df = quartiles_df.reset_index(drop=True)
-            # quartiles_df[['dataset', 'table']] = quartiles_df['dataset|table'].str.split("|", expand=True)
+        q1, q2 = self.nan_percentiles(history[:, candidates], [threshold, 100 - threshold])
+        iqr = q2 - q1
+        candidate_last = last[candidates]
+
+        out_of_fence = (candidate_last < (q1 - (1.5 * iqr))) | (candidate_last > (q2 + (1.5 * iqr)))
+
+        return candidates, candidate_last, q1, q2, out_of_fence
+
+    def find_anomalous_columns(self, values, threshold):
+        # Positions of the anomalous columns with their last value, q1 and q2
+        columns, last, q1, q2, out_of_fence = self.fence_stats(values, threshold)
+
+        return columns[out_of_fence], last[out_of_fence], q1[out_of_fence], q2[out_of_fence]
+
+    def backtest_thresholds(self, pivot_df, thresholds, window_days=None, evaluate_from=None, block_series=1024):
+        # Replays the fence rule of detect_anomalies on every day of the pivot
+        # (dates x series) instead of the last one only, for each threshold, and
+        # returns the alert rate per threshold. A day's history is every earlier
+        # day, or with window_days the days in [day - window_days, day), as in a
+        # live run with lookback_days. Only days from evaluate_from on are
+        # counted. Series are processed block_series at a time to bound memory.
+        pivot_df = pivot_df.sort_index()
+        dates = pd.DatetimeIndex(pd.to_datetime(pivot_df.index))
+        values = pivot_df.to_numpy(dtype=np.float64, na_value=np.nan)
+        rows = values.shape[0]
 
-            return quartiles_df
+        if window_days is None:
+            window_starts = np.zeros(rows, dtype=np.intp)
         else:
+            window_starts = np.searchsorted(dates, dates - pd.Timedelta(days=int(window_days)), side='left')
+
+        evaluated_days = np.ones(rows, dtype=bool) if evaluate_from is None else dates >= pd.Timestamp(evaluate_from)
+
+        percentiles = [percentile for threshold in thresholds for percentile in (threshold, 100 - threshold)]
+        evaluated = np.zeros(len(thresholds), dtype=np.int64)
+        alerts = np.zeros(len(thresholds), dtype=np.int64)
+        alerting_series = np.zeros(len(thresholds), dtype=np.int64)
+        alert_days = np.zeros((len(thresholds), rows), dtype=bool)
+
+        for first_series in range(0, values.shape[1], block_series):
+            block = values[:, first_series:first_series + block_series]
+            # Only the evaluated days' windows are computed
+            quartiles, counts = window_nan_percentiles(block, percentiles, window_starts, rows=np.flatnonzero(evaluated_days))
+            current = block[evaluated_days]
+            enough_history = (counts >= 3) & ~np.isnan(current)
+
+            for i in range(len(thresholds)):
+                q1 = quartiles[2 * i]
+                q2 = quartiles[2 * i + 1]
+                iqr = q2 - q1
+
+                with np.errstate(invalid='ignore'):
+                    block_alerts = enough_history & ((current < (q1 - (1.5 * iqr))) | (current > (q2 + (1.5 * iqr))))
+
+                evaluated[i] += enough_history.sum()
+                alerts[i] += block_alerts.sum()
+                alerting_series[i] += block_alerts.any(axis=0).sum()
+                alert_days[i, evaluated_days] |= block_alerts.any(axis=1)
+
+        return pd.DataFrame({
+            'threshold': list(thresholds), 
+            'days': int(evaluated_days.sum()), 
+            'evaluated': evaluated, 
+            'alerts': alerts, 
+            'alert_rate': alerts / np.maximum(evaluated, 1), 
+            'alerting_series': alerting_series, 
+            'alert_days': alert_days.sum(axis=1)
+        })
+
+    def compact_result_frames(self, frames):
+        # Reduces (date, column_to_pivot_on, current_day_rows) result pages to
+        # int32 date and series codes and float32 values, 12 bytes per row,
+        # instead of keeping the pages' object-dtype keys or a dense float64
+        # pivot. Codes follow the sorted dates and series names, as pivot_table
+        # orders them, and rows with a null key or value are dropped, as
+        # pivot_table drops them. Returns (dates, series, date_codes,
+        # series_codes, values).
+        dates = None
+        series = None
+        date_codes = []
+        series_codes = []
+        values = []
+
+        for frame in frames:
+            metrics.add('rows_fetched', frame.shape[0])
+
+            frame = frame[frame['date'].notna() & frame['column_to_pivot_on'].notna() & frame['current_day_rows'].notna()]
+
+            page_date_codes, page_dates = pd.factorize(frame['date'])
+            page_series_codes, page_series = pd.factorize(frame['column_to_pivot_on'])
+
+            dates, date_lookup = self._extend_keys(dates, page_dates)
+            series, series_lookup = self._extend_keys(series, page_series)
+
+            date_codes.append(date_lookup[page_date_codes])
+            series_codes.append(series_lookup[page_series_codes])
+            values.append(frame['current_day_rows'].to_numpy(dtype=np.float32))
+
+        dates = pd.Index([] if dates is None else dates, name='date')
+        series = pd.Index([] if series is None else series, name='column_to_pivot_on')
+
+        date_codes = np.concatenate(date_codes) if len(date_codes) > 0 else np.empty(0, dtype=np.int32)
+        series_codes = np.concatenate(series_codes) if len(series_codes) > 0 else np.empty(0, dtype=np.int32)
+        values = np.concatenate(values) if len(values) > 0 else np.empty(0, dtype=np.float32)
+
+        # Renumber codes in sorted key order
+        date_order = dates.argsort()
+        date_rank = np.empty(len(dates), dtype=np.int32)
+        date_rank[date_order] = np.arange(len(dates), dtype=np.int32)
+
+        series_order = series.argsort()
+        series_rank = np.empty(len(series), dtype=np.int32)
+        series_rank[series_order] = np.arange(len(series), dtype=np.int32)
+
+        return dates[date_order], series[series_order], date_rank[date_codes], series_rank[series_codes], values
+
+    def _extend_keys(self, keys, page_keys):
+        # Appends the page's unseen keys to keys and returns the int32 code of
+        # each page key
+        page_keys = pd.Index(page_keys)
+
+        if keys is None:
+            return page_keys, np.arange(len(page_keys), dtype=np.int32)
+
+        lookup = keys.get_indexer(page_keys).astype(np.int32)
+        unseen = lookup < 0
+
+        if unseen.any():
+            lookup[unseen] = len(keys) + np.arange(np.count_nonzero(unseen), dtype=np.int32)
+            keys = keys.append(page_keys[unseen])
+
+        return keys, lookup
+
+    def get_compact_result(self, credentials, query_script, project_id, maximum_bytes_billed=None):
+        return self.compact_result_frames(
+            self.iter_query_result_frames(credentials, query_script, project_id, maximum_bytes_billed)
+        )
+
+    def detect_anomalies_compact(self, compact_result, threshold, block_series=None, all_series=False):
+        # detect_anomalies over a compact_result_frames result, one block of
+        # block_series series at a time: each block is expanded to a dense
+        # float64 (dates x block_series) array, duplicates (date, series) rows
+        # averaged as pivot_table does, so only one block is ever dense.
+        # Results match detect_anomalies on the pivot_table of the same rows
+        # as long as the values are exact in float32 (integers below 2**24).
+        # all_series is as in detect_anomalies.
+        dates, series, date_codes, series_codes, values = compact_result
+        block_series = block_series if block_series is not None else self.compact_block_series
+
+        if len(dates) < 2 or len(series) == 0:
+            print(f"No anomalies found")
+            return pd.DataFrame()
+
+        # Row positions grouped by block, and where each block starts
+        block_ids = series_codes // block_series
+        order = np.argsort(block_ids, kind='stable')
+        block_starts = np.concatenate([[0], np.cumsum(np.bincount(block_ids, minlength=-(-len(series) // block_series)))])
+        del block_ids
+
+        anomalies = []
+
+        for block in range(len(block_starts) - 1):
+            rows = order[block_starts[block]:block_starts[block + 1]]
+            first_series = block * block_series
+            width = min(block_series, len(series) - first_series)
+
+            cells = date_codes[rows].astype(np.intp) * width + (series_codes[rows] - first_series)
+            sums = np.bincount(cells, weights=values[rows].astype(np.float64), minlength=len(dates) * width)
+            counts = np.bincount(cells, minlength=len(dates) * width)
+
+            block_values = np.full(len(dates) * width, np.nan)
+            np.divide(sums, counts, out=block_values, where=counts > 0)
+
+            block_values = block_values.reshape(len(dates), width)
+
+            if all_series:
+                columns, last, q1, q2, anomaly = self.fence_stats(block_values, threshold)
+            else:
+                columns, last, q1, q2 = self.find_anomalous_columns(block_values, threshold)
+                anomaly = np.ones(len(columns), dtype=bool)
+
+            if len(columns) > 0:
+                anomalies.append((columns + first_series, last, q1, q2, anomaly))
+
+        if len(anomalies) == 0:
             print(f"No anomalies found")
             return pd.DataFrame()
+
+        columns, last, q1, q2, anomaly = (np.concatenate(parts) for parts in zip(*anomalies))
+
+        series_df = pd.DataFrame({
+            'dataset|table': series[columns], 
+            "today's rows": last, 
+            "10%": q1, 
+            "90%": q2
+        })
+
+        if all_series:
+            series_df['anomaly'] = anomaly
+
+        return series_df